@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+# Copyright (c) 2015 Code for Karlsruhe (http://codefor.de/karlsruhe)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Batch OCR of archived images.
+
+Extracts the text from a directory or tarball of PNG images as they are
+downloaded by the scraper, using all CPU cores. The results are written
+to a file with one JSON object per line and per image, containing the
+image's name (``file``) and either its text (``text``) or the error
+that occurred while processing it (``error``). Images which are already
+listed in the result file are skipped, so that an interrupted run can
+simply be restarted.
+"""
+
+import codecs
+import errno
+import itertools
+import json
+import multiprocessing
+import os
+import os.path
+import sys
+import tarfile
+import time
+
+import scrape
+
+
+# Number of images that are handed to the worker processes at once
+BATCH_SIZE = 1000
+
+
+def iter_directory(directory):
+    """
+    Iterate over the PNG images in a directory.
+
+    Yields 2-tuples of file name (relative to ``directory``) and image
+    data. Sub-directories are included.
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith('.png'):
+                filename = os.path.join(root, name)
+                with open(filename, 'rb') as f:
+                    yield os.path.relpath(filename, directory), f.read()
+
+
+def iter_tarball(filename):
+    """
+    Iterate over the PNG images in a (possibly compressed) tarball.
+
+    The tarball is read as a stream. Yields 2-tuples of member name and
+    image data.
+    """
+    with tarfile.open(filename, 'r|*') as tar:
+        for member in tar:
+            if member.isfile() and member.name.lower().endswith('.png'):
+                yield member.name, tar.extractfile(member).read()
+
+
+def iter_images(source):
+    """
+    Iterate over the PNG images in a directory or tarball.
+    """
+    if os.path.isdir(source):
+        return iter_directory(source)
+    return iter_tarball(source)
+
+
+def load_done(filename):
+    """
+    Get the names of the images listed in a result file.
+
+    A missing result file is treated like an empty one. An incomplete
+    last line (e.g. from a crash) is removed from the file.
+    """
+    done = set()
+    try:
+        with open(filename, 'r+b') as f:
+            size = 0
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                size += len(line)
+                try:
+                    done.add(json.loads(line.decode('utf8'))['file'])
+                except ValueError:
+                    pass
+            f.truncate(size)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return done
+
+
+def process(item):
+    """
+    Extract the text from an image.
+
+    ``item`` is a 2-tuple of name and image data. Returns a result
+    dictionary as described in the module documentation.
+    """
+    name, data = item
+    try:
+        return {'file': name, 'text': scrape.get_text(scrape.decode_image(data))}
+    except Exception as e:
+        return {'file': name, 'error': '%s: %s' % (e.__class__.__name__, e)}
+
+
+def _init_worker(max_distance, engine, use_numpy):
+    scrape.MAX_DISTANCE = max_distance
+    scrape.ENGINE = engine
+    scrape.USE_NUMPY = use_numpy
+
+
+def run(images, output, processes=None, max_distance=scrape.MAX_DISTANCE,
+        progress=None, engine=scrape.ENGINE, use_numpy=scrape.USE_NUMPY):
+    """
+    Extract the text from images and write the results to a file.
+
+    ``images`` is an iterable of 2-tuples of name and image data and
+    ``output`` is the name of the result file. Images already listed in
+    the result file are skipped, new results are appended to it.
+
+    ``processes`` is the number of worker processes (defaults to the
+    number of CPUs), ``max_distance`` is passed on to
+    ``scrape.classify`` and ``engine`` selects the OCR engine (see
+    ``scrape.get_text``). ``use_numpy`` selects the NumPy backend of the
+    character segmentation (see ``scrape.USE_NUMPY``). If ``progress`` is
+    given then it is called with the numbers of processed, skipped and
+    failed images after each image.
+
+    Returns a 3-tuple of the numbers of processed, skipped and failed
+    images.
+    """
+    done = load_done(output)
+    counts = [0, 0, 0]
+
+    def todo():
+        for name, data in images:
+            if name in done:
+                counts[1] += 1
+            else:
+                yield name, data
+
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (max_distance, engine, use_numpy))
+    try:
+        with codecs.open(output, 'a', encoding='utf8') as f:
+            pending = todo()
+            while True:
+                batch = list(itertools.islice(pending, BATCH_SIZE))
+                if not batch:
+                    break
+                for result in pool.imap_unordered(process, batch, 16):
+                    f.write(json.dumps(result, sort_keys=True) + '\n')
+                    f.flush()
+                    counts[0] += 1
+                    if 'error' in result:
+                        counts[2] += 1
+                    if progress:
+                        progress(*counts)
+    finally:
+        pool.close()
+        pool.join()
+    return tuple(counts)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+            description=__doc__.strip().split('\n', 1)[0])
+    parser.add_argument('source', help='Directory or tarball with PNG images')
+    parser.add_argument('output', help='Result file')
+    parser.add_argument('--processes', type=int,
+                        help='Number of worker processes (default: number ' +
+                             'of CPUs)')
+    parser.add_argument('--max-distance', type=int,
+                        default=scrape.MAX_DISTANCE,
+                        help='Maximum number of differing pixels for ' +
+                             'approximate character matches ' +
+                             '(default: %(default)s)')
+    parser.add_argument('--engine', choices=scrape.ENGINES,
+                        default=scrape.ENGINE,
+                        help='OCR engine (default: %(default)s)')
+    parser.add_argument('--backend', choices=scrape.BACKENDS,
+                        default=scrape.BACKEND,
+                        help='Implementation of the character segmentation ' +
+                             'of the segment engine, numpy requires NumPy ' +
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+    use_numpy = args.backend == 'numpy'
+    if use_numpy and scrape.get_numpy() is None:
+        parser.error('The numpy backend requires NumPy')
+
+    start = time.time()
+    last_report = [start]
+
+    def report(processed, skipped, failed, force=False):
+        now = time.time()
+        if force or now - last_report[0] >= 1:
+            last_report[0] = now
+            sys.stderr.write('\r%d processed (%.0f/s), %d skipped, %d failed' % (
+                             processed, processed / max(now - start, 1e-9),
+                             skipped, failed))
+            sys.stderr.flush()
+
+    counts = run(iter_images(args.source), args.output, args.processes,
+                 args.max_distance, report, args.engine, use_numpy)
+    report(*counts, force=True)
+    sys.stderr.write('\n')
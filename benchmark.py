@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+# Copyright (c) 2015 Code for Karlsruhe (http://codefor.de/karlsruhe)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Micro-benchmarks for the OCR.
+
+The test images are rendered from the character signatures in the
+classification table, so neither network access nor the GD library is
+required. Each stage of the OCR is timed separately and end to end, for
+each available backend. The results can be stored as JSON and compared
+against a previous run.
+"""
+
+import cStringIO
+import json
+import platform
+import timeit
+
+import PIL.Image
+
+import bitmap
+import scrape
+import simulate
+
+
+# Test strings: All known characters, typical indicator values and the
+# date label
+CASES = [
+    ('glyphs', ''.join(sorted(c for c in scrape.CLASSES.itervalues() if c != ' '))),
+    ('value', '12.3'),
+    ('value-long', '645.25'),
+    ('date', 'Stand: 21 Sep 15 10:00'),
+]
+
+# Margin around the text (in pixels)
+MARGIN = 2
+
+# Minimum total duration of one timing run (in seconds)
+MIN_TIME = 0.05
+
+# Number of timing runs per stage, the fastest one is reported
+REPEAT = 5
+
+# Default factor by which a stage may be slower than in the baseline
+# before it is reported as a regression
+THRESHOLD = 1.2
+
+
+def render_png(text):
+    """
+    Render text into a PNG image like the ones served by the homepage.
+
+    The text is surrounded by a margin and a black border as expected by
+    ``scrape.decode_image`` (see ``simulate.render``). Returns the PNG
+    data as a string.
+    """
+    width, height = simulate.text_size(text)
+    return simulate.render(text, width + 2 * MARGIN + 3,
+                           height + 2 * MARGIN + 3)
+
+
+def decode_pil(data):
+    """
+    Decode an image like ``scrape.decode_image`` but using PIL.
+    """
+    img = PIL.Image.open(cStringIO.StringIO(data))
+    left, top, right, bottom = scrape.BORDER
+    return bitmap.from_image(img.crop((left, top, img.size[0] - right,
+                                       img.size[1] - bottom)))
+
+
+def measure(func):
+    """
+    Measure the run time of a function.
+
+    Returns the run time of a single call in seconds.
+    """
+    timer = timeit.Timer(func)
+    number = max(1, int(MIN_TIME / max(timer.timeit(1), 1e-9)))
+    return min(timer.repeat(REPEAT, number)) / number
+
+
+def get_stages(text):
+    """
+    Get the OCR stages for a test string.
+
+    Returns a list of 2-tuples of stage name and a function which runs
+    the stage on the rendered text.
+    """
+    png = render_png(text)
+    img = scrape.decode_image(png)
+    if decode_pil(png) != img:
+        raise ValueError('Decoders disagree on rendered text "%s"' % text)
+    for engine in scrape.ENGINES:
+        if scrape.get_text(img, engine=engine) != text:
+            raise ValueError('Rendered text "%s" is not recognized correctly '
+                             'by the %s engine' % (text, engine))
+    vcount = scrape.count_black_pixels(img)[1]
+    boxes = []
+    for left, right in scrape.split(vcount):
+        top, bottom = scrape.strip(scrape.count_black_pixels(img, left=left, right=right)[0])
+        boxes.append((left, top, right, bottom))
+    sigs = scrape.get_char_signatures(img)
+
+    def fresh():
+        # Bitmaps cache their columns, so the stages which need them get
+        # a new bitmap on each run
+        return bitmap.Bitmap(img.width, img.height, img.rows)
+
+    noisy = [(w, h, bits ^ 1) if w else (w, h, bits) for w, h, bits in sigs]
+    return [
+        ('decode_image', lambda: scrape.decode_image(png)),
+        ('decode_image_pil', lambda: decode_pil(png)),
+        ('count_black_pixels', lambda: scrape.count_black_pixels(fresh())),
+        ('split', lambda: scrape.split(vcount)),
+        ('get_block_signature', lambda: [scrape.get_block_signature(img, *box)
+                                         for box in boxes]),
+        ('get_char_signatures', lambda: scrape.get_char_signatures(fresh())),
+        ('classify', lambda: [scrape.classify(sig) for sig in sigs]),
+        ('classify_noisy', lambda: [scrape.classify(sig) for sig in noisy]),
+        ('end_to_end', lambda: scrape.get_text(scrape.decode_image(png),
+                                               engine='segment')),
+        ('columns', lambda: fresh().columns()),
+        ('match_templates', lambda: scrape.match_templates(fresh())),
+        ('end_to_end_template', lambda: scrape.get_text(
+                scrape.decode_image(png), engine='template')),
+    ]
+
+
+def get_backends():
+    """
+    Get the available OCR backends.
+
+    Returns a list of 2-tuples of backend name and value for
+    ``scrape.USE_NUMPY``.
+    """
+    backends = [('python', False)]
+    if scrape.get_numpy() is not None:
+        backends.append(('numpy', True))
+    return backends
+
+
+def run(progress=None):
+    """
+    Run the benchmarks.
+
+    If ``progress`` is given then it is called with the name and the
+    result of each benchmark.
+
+    Returns a dictionary which maps benchmark names (of the form
+    ``backend/case/stage``) to run times in seconds.
+    """
+    results = {}
+    old = scrape.USE_NUMPY
+    try:
+        for backend, use_numpy in get_backends():
+            scrape.USE_NUMPY = use_numpy
+            for case, text in CASES:
+                for stage, func in get_stages(text):
+                    name = '%s/%s/%s' % (backend, case, stage)
+                    results[name] = measure(func)
+                    if progress:
+                        progress(name, results[name])
+    finally:
+        scrape.USE_NUMPY = old
+    return results
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """
+    Compare benchmark results against a baseline.
+
+    Returns a list of 3-tuples of benchmark name, current run time and
+    baseline run time for all benchmarks which are more than
+    ``threshold`` times slower than in the baseline.
+    """
+    regressions = []
+    for name, seconds in sorted(results.iteritems()):
+        if name in baseline and seconds > threshold * baseline[name]:
+            regressions.append((name, seconds, baseline[name]))
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(
+            description=__doc__.strip().split('\n', 1)[0])
+    parser.add_argument('--output', metavar='FILE',
+                        help='Store the results in this file')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='Compare the results against this file')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='Maximum slowdown factor compared to the ' +
+                             'baseline (default: %(default)s)')
+    args = parser.parse_args()
+
+    def report(name, seconds):
+        print '%-45s %10.1f µs' % (name, seconds * 1e6)
+        sys.stdout.flush()
+
+    results = run(report)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'numpy': getattr(scrape.get_numpy(), '__version__', None),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for name, seconds, previous in regressions:
+            print 'REGRESSION: %s took %.1f µs (baseline: %.1f µs, %+.0f%%)' % (
+                  name, seconds * 1e6, previous * 1e6,
+                  100 * (seconds / previous - 1))
+        if regressions:
+            sys.exit(1)
+        print 'No regressions.'
@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+# Copyright (c) 2015 Code for Karlsruhe (http://codefor.de/karlsruhe)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Black-and-white bitmaps and a minimal PNG decoder.
+
+The OCR only distinguishes black pixels from all others, so images are
+represented as ``Bitmap`` instances which store one integer bitmask per
+row. ``decode_png`` decodes PNG data directly into such a bitmap without
+creating any intermediate images: The chunks are sliced out of the data
+without copying them and the decompressed rows are mapped to black and
+white using string translation. Images which it does not support are
+decoded using PIL instead (see ``from_image``).
+
+A pixel is black if its luminance as computed by PIL (ITU-R 601-2) is
+zero.
+"""
+
+import struct
+import zlib
+
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+_CHUNK_HEADER = struct.Struct('>I4s')
+_CRC = struct.Struct('>I')
+_IHDR = struct.Struct('>IIBBBBB')
+
+# Number of samples per pixel by PNG color type
+_CHANNELS = {
+    0: 1,  # Grayscale
+    2: 3,  # RGB
+    3: 1,  # Palette
+    4: 2,  # Grayscale and alpha
+    6: 4,  # RGB and alpha
+}
+
+
+class UnsupportedImage(ValueError):
+    """
+    Raised by ``decode_png`` for data which it cannot decode.
+    """
+
+
+def is_black(red, green, blue):
+    """
+    Check whether a color is black.
+    """
+    return (red * 19595 + green * 38470 + blue * 7471 + 0x8000) >> 16 == 0
+
+
+# Translation table which maps black pixels (of an image in mode ``L``)
+# to ``1`` and all other pixels to ``0``
+_BLACK = ''.join('1' if is_black(v, v, v) else '0' for v in range(256))
+
+
+class Bitmap(object):
+    """
+    A black-and-white image.
+
+    ``rows`` is a list containing an integer bitmask for each row, in
+    which bit ``x`` is set if the pixel in column ``x`` is black.
+    """
+
+    def __init__(self, width, height, rows):
+        self.width = width
+        self.height = height
+        self.rows = rows
+        self._columns = None
+
+    def __repr__(self):
+        return '<Bitmap %dx%d>' % (self.width, self.height)
+
+    def __eq__(self, other):
+        return (isinstance(other, Bitmap) and self.size == other.size and
+                self.rows == other.rows)
+
+    def __ne__(self, other):
+        return not self == other
+
+    @property
+    def size(self):
+        """
+        The width and height of the bitmap.
+        """
+        return self.width, self.height
+
+    def columns(self):
+        """
+        Get the black pixels of each column.
+
+        Returns a list containing an integer bitmask for each column, in
+        which bit ``y`` is set if the pixel in row ``y`` is black.
+        """
+        if self._columns is None:
+            width = self.width
+            pattern = '0%db' % width
+            data = ''.join(format(row, pattern)[::-1] for row in self.rows)
+            columns = []
+            for x in xrange(width):
+                column = data[x::width][::-1]
+                columns.append(int(column, 2) if column else 0)
+            self._columns = columns
+        return self._columns
+
+
+def _pack_row(pixels):
+    """
+    Pack a string of ``0`` and ``1`` pixels into a row bitmask.
+    """
+    return int(pixels[::-1], 2) if pixels else 0
+
+
+def from_image(img):
+    """
+    Create a bitmap from a ``PIL.Image.Image`` instance.
+    """
+    width, height = img.size
+    if img.mode in ('1', 'L'):
+        data = img.convert('L').tobytes().translate(_BLACK)
+    elif img.mode == 'P' and img.palette.mode == 'RGB':
+        palette = img.palette.tobytes()
+        data = img.tobytes().translate(_get_tables(3, 8, palette)[0])
+    else:
+        # The luminance computed by ``convert('L')`` depends on the PIL
+        # version
+        data = _rgb_pixels(img.convert('RGB').tobytes(), 3)
+    return Bitmap(width, height, [_pack_row(data[i:i + width])
+                                  for i in xrange(0, width * height, width)])
+
+
+# Maximum number of lookup tables kept by ``_get_tables``
+MAX_TABLES = 64
+
+_tables = {}
+
+
+def _get_tables(color_type, depth, palette):
+    """
+    Get the lookup tables for images with one sample per pixel.
+
+    Returns a 2-tuple. The first item is a translation table which maps
+    samples (grayscale values or palette indices) to ``1`` for black
+    and ``0`` for other pixels. If ``depth`` is less than 8 then the
+    second item is a list which maps each byte of a row to the string
+    of its pixels, otherwise it is ``None``.
+
+    The images of a server usually share their palette, so the tables
+    are cached.
+    """
+    key = (color_type, depth, palette)
+    try:
+        return _tables[key]
+    except KeyError:
+        pass
+    if color_type == 3:
+        if palette is None:
+            raise UnsupportedImage('Palette is missing')
+        colors = bytearray(palette)
+        table = ['1' if is_black(*colors[i:i + 3]) else '0'
+                 for i in xrange(0, len(colors) - 2, 3)]
+        table = ''.join(table[:256]) + '0' * (256 - len(table))
+    else:
+        scale = 255 // ((1 << depth) - 1)
+        table = ''.join('1' if v < 1 << depth and is_black(*[v * scale] * 3)
+                        else '0' for v in range(256))
+    unpack = None
+    if depth < 8:
+        mask = (1 << depth) - 1
+        shifts = range(8 - depth, -1, -depth)
+        unpack = [''.join(table[byte >> shift & mask] for shift in shifts)
+                  for byte in range(256)]
+    if len(_tables) >= MAX_TABLES:
+        _tables.clear()
+    _tables[key] = table, unpack
+    return table, unpack
+
+
+def _paeth(a, b, c):
+    p = a + b - c
+    pa = abs(p - a)
+    pb = abs(p - b)
+    pc = abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    if pb <= pc:
+        return b
+    return c
+
+
+def _unfilter(kind, row, prev, bpp):
+    """
+    Reverse the filtering of a row.
+
+    ``row`` and ``prev`` (the previous unfiltered row, ``None`` for the
+    first one) are ``bytearray`` instances. ``row`` is modified in place.
+    """
+    count = len(row)
+    if prev is None:
+        prev = bytearray(count)
+    if kind == 1:
+        for i in xrange(bpp, count):
+            row[i] = (row[i] + row[i - bpp]) & 0xff
+    elif kind == 2:
+        for i in xrange(count):
+            row[i] = (row[i] + prev[i]) & 0xff
+    elif kind == 3:
+        for i in xrange(count):
+            left = row[i - bpp] if i >= bpp else 0
+            row[i] = (row[i] + ((left + prev[i]) >> 1)) & 0xff
+    elif kind == 4:
+        for i in xrange(count):
+            if i >= bpp:
+                row[i] = (row[i] + _paeth(row[i - bpp], prev[i],
+                                          prev[i - bpp])) & 0xff
+            else:
+                row[i] = (row[i] + prev[i]) & 0xff
+    else:
+        raise UnsupportedImage('Invalid filter type %d' % kind)
+
+
+def _rgb_pixels(row, channels):
+    """
+    Map the pixels of an unfiltered RGB(A) row to ``0`` and ``1``.
+    """
+    row = bytearray(row)
+    return ''.join('1' if is_black(row[i], row[i + 1], row[i + 2]) else '0'
+                   for i in xrange(0, len(row), channels))
+
+
+def decode_png(data, trim=(0, 0, 0, 0)):
+    """
+    Decode PNG data into a ``Bitmap``.
+
+    ``trim`` is a 4-tuple of the number of pixels which are cut off at
+    the left, top, right and bottom of the image.
+
+    Interlaced images and images with 16 bits per sample are not
+    supported. For these and for invalid data ``UnsupportedImage`` is
+    raised.
+    """
+    if data[:len(PNG_SIGNATURE)] != PNG_SIGNATURE:
+        raise UnsupportedImage('Not a PNG image')
+    header = None
+    palette = None
+    decompressor = zlib.decompressobj()
+    compressed = []
+    offset = len(PNG_SIGNATURE)
+    try:
+        while True:
+            length, kind = _CHUNK_HEADER.unpack_from(data, offset)
+            start = offset + _CHUNK_HEADER.size
+            end = start + length
+            crc = _CRC.unpack_from(data, end)[0]
+            if zlib.crc32(buffer(data, offset + 4, length + 4)) & 0xffffffff != crc:
+                raise UnsupportedImage('Invalid checksum of %s chunk' % kind)
+            if kind == 'IHDR':
+                header = _IHDR.unpack_from(data, start)
+            elif kind == 'PLTE':
+                palette = data[start:end]
+            elif kind == 'IDAT':
+                compressed.append(decompressor.decompress(buffer(data, start,
+                                                                 length)))
+            elif kind == 'IEND':
+                break
+            offset = end + _CRC.size
+    except (struct.error, zlib.error) as e:
+        raise UnsupportedImage('Invalid PNG data: %s' % e)
+    if header is None:
+        raise UnsupportedImage('Header is missing')
+    width, height, depth, color_type, _, _, interlace = header
+    if interlace:
+        raise UnsupportedImage('Interlaced images are not supported')
+    if (color_type not in _CHANNELS or depth not in (1, 2, 4, 8) or
+            (_CHANNELS[color_type] > 1 and depth != 8)):
+        raise UnsupportedImage('Unsupported color type %d with depth %d' %
+                               (color_type, depth))
+    raw = ''.join(compressed)
+    channels = _CHANNELS[color_type]
+    stride = (width * channels * depth + 7) // 8
+    bpp = max(1, channels * depth // 8)
+    if len(raw) < height * (stride + 1):
+        raise UnsupportedImage('Image data is truncated')
+
+    left, top, right, bottom = trim
+    right = max(left, width - right)
+    bottom = max(top, height - bottom)
+    if color_type != 2 and color_type != 6:
+        table, unpack = _get_tables(color_type, depth, palette)
+
+    rows = []
+    prev = None
+    for y in xrange(min(height, bottom)):
+        pos = y * (stride + 1)
+        kind = ord(raw[pos])
+        if kind:
+            row = bytearray(raw[pos + 1:pos + 1 + stride])
+            _unfilter(kind, row, prev, bpp)
+            prev = row
+        elif y + 1 < height and raw[pos + stride + 1] != '\x00':
+            prev = row = bytearray(raw[pos + 1:pos + 1 + stride])
+        elif y < top:
+            continue
+        else:
+            row = raw[pos + 1:pos + 1 + stride]
+        if y < top:
+            continue
+        if channels != 1:
+            if color_type == 4:
+                pixels = str(row)[::2].translate(table)
+            else:
+                pixels = _rgb_pixels(row, channels)
+        elif depth < 8:
+            pixels = ''.join([unpack[byte] for byte in bytearray(row)])
+        else:
+            pixels = str(row).translate(table)
+        rows.append(_pack_row(pixels[left:right]))
+    return Bitmap(right - left, bottom - top, rows)
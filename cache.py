@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+# Copyright (c) 2015 Code for Karlsruhe (http://codefor.de/karlsruhe)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Persistent cache for downloaded images.
+
+For each image URL the cache stores the HTTP validators (``ETag`` and
+``Last-Modified``) of the last download so that the next request can
+be made conditional. In addition, the text extracted from an image is
+stored under the SHA-256 digest of the image data. An image which has
+not changed therefore neither has to be downloaded nor analyzed again.
+
+The cache is stored as a JSON file.
+"""
+
+import codecs
+import errno
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+import threading
+import time
+
+
+# Maximum number of URLs and of texts kept in the cache
+MAX_ENTRIES = 1000
+
+# Maximum time (in seconds) since their last use for which cache entries
+# are kept
+MAX_AGE = 30 * 24 * 60 * 60
+
+
+def digest(data):
+    """
+    Compute the hex-encoded SHA-256 digest of a string.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+class ImageCache(object):
+    """
+    Cache for image validators and extracted texts.
+
+    ``filename`` is the name of the cache file. It is loaded if it
+    exists and written by ``save``. When the cache is saved, entries
+    which have not been used for more than ``max_age`` seconds are
+    removed and, if there are still more than ``max_entries`` entries,
+    the least recently used ones are removed, too.
+
+    ``version`` identifies the way in which the texts are extracted from
+    the images (see ``scrape.ocr_version``). Texts which have been
+    extracted by a different version are discarded when the cache is
+    loaded, so that the images are analyzed again.
+
+    Instances can be shared between threads.
+    """
+
+    def __init__(self, filename, max_entries=MAX_ENTRIES, max_age=MAX_AGE,
+                 version=None):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.version = version
+        self._lock = threading.Lock()
+        self._urls = {}
+        self._texts = {}
+        self.load()
+
+    def load(self):
+        """
+        Load the cache file.
+
+        A missing cache file is treated like an empty one.
+        """
+        try:
+            with codecs.open(self.filename, 'r', encoding='utf8') as f:
+                data = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            data = {}
+        with self._lock:
+            self._urls = data.get('urls', {})
+            if data.get('version') == self.version:
+                self._texts = data.get('texts', {})
+            else:
+                # Without their texts the URL entries are not used either
+                self._texts = {}
+
+    def save(self):
+        """
+        Remove outdated entries and write the cache file.
+
+        The file is replaced atomically.
+        """
+        with self._lock:
+            _evict(self._urls, self.max_entries, self.max_age)
+            _evict(self._texts, self.max_entries, self.max_age)
+            data = {'version': self.version, 'urls': self._urls,
+                    'texts': self._texts}
+            directory = os.path.dirname(os.path.abspath(self.filename))
+            fd, temp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f, separators=(',', ':'))
+                os.rename(temp, self.filename)
+            except:
+                os.remove(temp)
+                raise
+
+    def get_validators(self, url):
+        """
+        Get the headers for a conditional request for a URL.
+
+        Returns a dictionary which is empty if nothing is known about
+        the URL or if its text is no longer cached.
+        """
+        with self._lock:
+            entry = self._urls.get(url)
+            if not entry or entry['digest'] not in self._texts:
+                return {}
+            headers = {}
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+            return headers
+
+    def get_url_text(self, url):
+        """
+        Get the text of the image that was last downloaded from a URL.
+
+        Returns ``None`` if the text is not cached.
+        """
+        with self._lock:
+            entry = self._urls.get(url)
+            if not entry:
+                return None
+            entry['time'] = time.time()
+            return self._get_text(entry['digest'])
+
+    def get_text(self, digest):
+        """
+        Get the text of the image with the given digest.
+
+        Returns ``None`` if the text is not cached.
+        """
+        with self._lock:
+            return self._get_text(digest)
+
+    def _get_text(self, digest):
+        entry = self._texts.get(digest)
+        if not entry:
+            return None
+        entry['time'] = time.time()
+        return entry['text']
+
+    def update(self, url, headers, digest, text):
+        """
+        Store the results of a download.
+
+        ``url`` is the URL of the image, ``headers`` is the dictionary
+        of the response headers (with lower-case keys), ``digest`` is
+        the digest of the image data and ``text`` is the text extracted
+        from the image.
+        """
+        now = time.time()
+        with self._lock:
+            self._urls[url] = {
+                'etag': headers.get('etag'),
+                'last_modified': headers.get('last-modified'),
+                'digest': digest,
+                'time': now,
+            }
+            self._texts[digest] = {
+                'text': text,
+                'time': now,
+            }
+
+
+def _evict(entries, max_entries, max_age):
+    """
+    Remove outdated and least recently used entries from a dictionary.
+    """
+    oldest = time.time() - max_age
+    for key, entry in entries.items():
+        if entry['time'] < oldest:
+            del entries[key]
+    if len(entries) > max_entries:
+        keys = sorted(entries, key=lambda key: entries[key]['time'])
+        for key in keys[:len(entries) - max_entries]:
+            del entries[key]
@@ -27,7 +27,12 @@ Generate character classification table for image OCR.
 The homepage from which we scrape our data uses the GD graphics
 library to generate its diagrams. This script uses the same library
 to produce a sample image containing all characters from which a
-classification map is constructed. The map is printed to STDOUT.
+classification map is constructed. The map is written to a binary table
+file (see ``glyphs.py``) which is loaded by the scraper.
+
+Each key of the map is a character signature as returned by
+``scrape.get_char_signatures``, i.e. a 3-tuple of the character's
+width, its height and the bitmask of its black pixels.
 """
 
 import gd
@@ -52,27 +57,34 @@ def create_text_image(text, f, font=gd.gdFontLarge):
 
 
 if __name__ == '__main__':
-    import collections
+    import argparse
     import os
-    import pprint
-    import sys
     import tempfile
 
     import PIL.Image
 
-    from scrape import get_char_signatures
+    from bitmap import from_image
+    from glyphs import Glyph, write_table
+    from scrape import (CLASSES_FILE, count_black_pixels, get_block_signature,
+                        split, strip, SPACE)
+
+    parser = argparse.ArgumentParser(
+            description=__doc__.strip().split('\n', 1)[0])
+    parser.add_argument('output', nargs='?', default=CLASSES_FILE,
+                        help='Table file (default: %(default)s)')
+    args = parser.parse_args()
 
-    # We don't use ASCII char 34 (double quotes) because it is not
-    # connected and our OCR cannot handle such chars. We don't use
-    # char 39 (single quote) because in that font it is a translated
-    # version of "," and our OCR cannot distinguish them.
-    chars = ''.join(chr(i) for i in range(33, 127) if i not in [34, 39])
+    chars = ''.join(chr(i) for i in range(33, 127))
+
+    # Char 39 (single quote) is a translated version of "," in our font,
+    # so it cannot be told apart from "," by its signature.
+    ambiguous = "'"
 
     f = tempfile.NamedTemporaryFile(suffix='.png', delete=False)
     try:
         create_text_image(chars, f)
         f.seek(0)
-        img = PIL.Image.open(f).convert('L')
+        img = from_image(PIL.Image.open(f))
     finally:
         try:
             f.close()
@@ -83,21 +95,30 @@ if __name__ == '__main__':
         except:
             pass
 
-    sigs = get_char_signatures(img, space_width=float('Inf'))
-
-    if len(chars) != len(sigs):
-        sys.exit('Got %d chars in string but %d chars in image.' % (len(chars), len(sigs)))
-
-    table = collections.OrderedDict()
-    table[tuple()] = ' '
-    for char, sig in zip(chars, sigs):
-        if sig in table:
-            print "Warning: Duplicate sig %s for chars '%s' and '%s'." % (sig, table[sig], char)
-        else:
-            table[sig] = char
-
-    print '{'
-    for item in table.iteritems():
-        print '    %r: %r,' % item
-    print '}'
-
+    # The text is drawn at (1, 1) and each character occupies a cell of
+    # the same size
+    cell_width = (img.size[0] - 2) // len(chars)
+    cell_height = img.size[1] - 2
+
+    glyphs = [Glyph(SPACE, 0, True, ' ')]
+    seen = {SPACE: ' '}
+    for index, char in enumerate(chars):
+        left = 1 + index * cell_width
+        hcount, vcount = count_black_pixels(img, left=left, top=1,
+                                            right=left + cell_width,
+                                            bottom=1 + cell_height)
+        x0, x1 = strip(vcount)
+        y0, y1 = strip(hcount)
+        sig = get_block_signature(img, left + x0, 1 + y0, left + x1, 1 + y1)
+        # Characters which are not connected (e.g. double quotes) are
+        # split into pieces by ``scrape.get_char_signatures``
+        segmentable = len(split(vcount)) == 1 and char not in ambiguous
+        if segmentable and sig in seen:
+            print "Warning: Duplicate sig %s for chars '%s' and '%s'." % (sig, seen[sig], char)
+            segmentable = False
+        if segmentable:
+            seen[sig] = char
+        glyphs.append(Glyph(sig, y0, segmentable, char))
+
+    write_table(args.output, glyphs)
+    print 'Wrote %d characters to "%s".' % (len(glyphs), args.output)
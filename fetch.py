@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+# Copyright (c) 2015 Code for Karlsruhe (http://codefor.de/karlsruhe)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+HTTP downloads over persistent connections.
+
+Requests are sent over pools of keep-alive connections, one pool per
+host, so that several images can be downloaded concurrently without
+opening a new TCP connection for each of them. The number of connections
+and the request rate can be limited per host (see ``set_host_limits``)
+so that no single server is overloaded.
+
+Each request is subject to connect and read timeouts. Failed requests
+(network errors, timeouts and server errors) are retried with jittered
+exponential backoff until the request's total deadline has passed.
+Optionally, requests are hedged: If no response has arrived after the
+host's 95th percentile response time then a second, identical request
+is sent and whichever response arrives first is used.
+"""
+
+import collections
+import httplib
+import logging
+import math
+import Queue
+import random
+import socket
+import sys
+import threading
+import time
+import urllib2
+import urlparse
+
+
+log = logging.getLogger('codeforka-trinkwasser.fetch')
+
+
+# Maximum number of simultaneous connections to a single host
+MAX_CONNECTIONS = 6
+
+# Maximum number of requests per second to a single host (``None`` means
+# unlimited)
+MAX_RATE = None
+
+# Timeouts for establishing a connection and for each read from it (in
+# seconds)
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 15
+
+# Maximum number of retries of a failed request
+RETRIES = 3
+
+# Delay before the first retry and maximum delay between retries (in
+# seconds). The delay doubles with every retry, the actual delay is
+# drawn uniformly between zero and that value.
+BACKOFF = 0.5
+MAX_BACKOFF = 8
+
+# Maximum total duration of a request including all retries (in seconds)
+DEADLINE = 60
+
+# Response statuses for which a request is retried
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+# Whether requests are hedged, the percentile of the response times
+# after which the hedge request is sent and the number of response times
+# that must have been recorded for a host before its requests are hedged
+HEDGE = False
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+
+# Number of recent response times that are kept per host
+LATENCY_WINDOW = 200
+
+
+Response = collections.namedtuple('Response', ['status', 'headers', 'body'])
+
+
+class RateLimiter(object):
+    """
+    Limit the rate of events.
+
+    ``wait`` blocks the calling thread so that on average at most
+    ``rate`` events per second take place, with bursts of up to
+    ``burst`` events. Instances can be shared between threads.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def wait(self):
+        """
+        Wait until the next event may take place.
+        """
+        with self._lock:
+            now = time.time()
+            self._next = max(self._next, now - (self.burst - 1) / float(self.rate))
+            delay = self._next - now
+            self._next += 1.0 / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class LatencyTracker(object):
+    """
+    Keep track of recent response times.
+
+    Instances can be shared between threads.
+    """
+
+    def __init__(self, size=LATENCY_WINDOW):
+        self._lock = threading.Lock()
+        self._samples = collections.deque(maxlen=size)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, seconds):
+        """
+        Record a response time.
+        """
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, percent):
+        """
+        Get a percentile of the recent response times.
+
+        Returns ``None`` if no response times have been recorded.
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = int(math.ceil(percent / 100.0 * len(samples))) - 1
+        return samples[max(0, index)]
+
+
+class ConnectionPool(object):
+    """
+    Pool of persistent HTTP connections to a single host.
+
+    At most ``maxsize`` connections are in use at the same time. A
+    thread requesting a connection while all of them are busy blocks
+    until another thread returns its connection to the pool. If
+    ``rate`` is given then at most that many requests per second are
+    sent. The response times of the pool's requests are recorded in
+    ``latencies``.
+    """
+
+    def __init__(self, scheme, host, port=None, maxsize=MAX_CONNECTIONS,
+                 rate=MAX_RATE):
+        if scheme == 'https':
+            self._connection_class = httplib.HTTPSConnection
+        else:
+            self._connection_class = httplib.HTTPConnection
+        self.host = host
+        self.port = port
+        self.maxsize = maxsize
+        self._idle = Queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(maxsize)
+        self._limiter = RateLimiter(rate) if rate else None
+        self.latencies = LatencyTracker()
+
+    def _new_connection(self):
+        return self._connection_class(self.host, self.port)
+
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            return self._new_connection()
+
+    def _release(self, conn):
+        if conn is not None:
+            self._idle.put(conn)
+        self._slots.release()
+
+    def request(self, path, headers=None, timeout=None):
+        """
+        Send a GET request.
+
+        ``path`` is the request path including the query string and
+        ``headers`` is an optional dictionary of additional request
+        headers. ``timeout`` is an optional 2-tuple of connect and read
+        timeout in seconds.
+
+        Returns a ``Response`` instance. The response headers are
+        stored in a dictionary with lower-case keys.
+        """
+        conn = self._acquire()
+        if self._limiter:
+            self._limiter.wait()
+        try:
+            # A connection that has been idle for a while may have been
+            # closed by the server. In that case we retry once using a
+            # fresh connection.
+            reused = conn.sock is not None
+            try:
+                return _get(conn, path, headers, timeout)
+            except socket.timeout:
+                raise
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+                conn = self._new_connection()
+                return _get(conn, path, headers, timeout)
+        except:
+            conn.close()
+            conn = None
+            raise
+        finally:
+            self._release(conn)
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Queue.Empty:
+                break
+
+
+def _get(conn, path, headers, timeout=None):
+    if timeout is not None:
+        connect_timeout, read_timeout = timeout
+        if conn.sock is None:
+            conn.timeout = connect_timeout
+            conn.connect()
+        conn.sock.settimeout(read_timeout)
+    conn.request('GET', path, headers=headers or {})
+    response = conn.getresponse()
+    body = response.read()
+    return Response(response.status, dict(response.getheaders()), body)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_limits = {}
+
+
+def set_host_limits(host, max_connections=MAX_CONNECTIONS, rate=MAX_RATE):
+    """
+    Set the limits for requests to a host.
+
+    ``max_connections`` is the maximum number of simultaneous
+    connections and ``rate`` the maximum number of requests per second
+    (``None`` means unlimited). Existing pools for the host are closed
+    and replaced by new ones on next use.
+    """
+    with _pools_lock:
+        _limits[host] = (max_connections, rate)
+        for key in [key for key in _pools if key[1] == host]:
+            _pools.pop(key).close()
+
+
+def get_pool(scheme, host, port=None):
+    """
+    Get the connection pool for a host.
+
+    The pool is created on first use and shared afterwards.
+    """
+    key = (scheme, host, port)
+    with _pools_lock:
+        try:
+            return _pools[key]
+        except KeyError:
+            maxsize, rate = _limits.get(host, (MAX_CONNECTIONS, MAX_RATE))
+            pool = _pools[key] = ConnectionPool(scheme, host, port, maxsize,
+                                                rate)
+            return pool
+
+
+class _Attempt(object):
+    """
+    A single attempt of a request.
+
+    The response time of successful attempts is recorded in the pool.
+    """
+
+    def __init__(self, pool, path, headers, timeout):
+        self.pool = pool
+        self.path = path
+        self.headers = headers
+        self.timeout = timeout
+
+    def __call__(self):
+        start = time.time()
+        response = self.pool.request(self.path, self.headers, self.timeout)
+        if response.status not in RETRY_STATUSES:
+            self.pool.latencies.add(time.time() - start)
+        return response
+
+
+def _hedged(attempt, delay, deadline, metrics=None):
+    """
+    Run an attempt and hedge it after ``delay`` seconds.
+
+    Both attempts run in background threads. Returns the first
+    successful response. If both attempts fail then the last error is
+    raised, and ``socket.timeout`` is raised if ``deadline`` (a
+    timestamp) passes without a response.
+    """
+    results = Queue.Queue()
+
+    def run(index):
+        try:
+            results.put((index, attempt(), None))
+        except Exception:
+            results.put((index, None, sys.exc_info()))
+
+    def start(index):
+        thread = threading.Thread(target=run, args=(index,))
+        thread.daemon = True
+        thread.start()
+
+    start(0)
+    pending = 1
+    hedged = False
+    error = None
+    while pending:
+        wait = deadline - time.time()
+        if not hedged:
+            wait = min(wait, delay)
+        try:
+            index, response, error_info = results.get(timeout=max(0, wait))
+        except Queue.Empty:
+            if hedged or time.time() >= deadline:
+                raise socket.timeout('Request deadline exceeded')
+            hedged = True
+            pending += 1
+            log.info('No response after %.3fs, sending hedge request for "%s"',
+                     delay, attempt.path)
+            if metrics:
+                metrics.inc('http_hedges_total', result='sent')
+            start(1)
+            continue
+        pending -= 1
+        if error_info is None:
+            if index == 1 and metrics:
+                metrics.inc('http_hedges_total', result='won')
+            return response
+        error = error_info
+    raise error[0], error[1], error[2]
+
+
+def request(url, headers=None, metrics=None):
+    """
+    Send a GET request for a URL.
+
+    The request is sent using the connection pool of the URL's host.
+    ``headers`` is an optional dictionary of additional request headers.
+
+    Network errors, timeouts and responses with a status in
+    ``RETRY_STATUSES`` are retried (see ``RETRIES``, ``BACKOFF`` and
+    ``DEADLINE``) and requests are hedged if ``HEDGE`` is true. Retries
+    and hedges are logged and, if ``metrics`` is a ``metrics.Metrics``
+    instance, counted.
+
+    Returns a ``Response`` instance regardless of the response status
+    (the last one if all attempts are answered with a status in
+    ``RETRY_STATUSES``). If all attempts fail then the last error is
+    raised.
+    """
+    parts = urlparse.urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    pool = get_pool(parts.scheme, parts.hostname, parts.port)
+    deadline = time.time() + DEADLINE
+    retry = 0
+    while True:
+        remaining = deadline - time.time()
+        attempt = _Attempt(pool, path, headers,
+                           (min(CONNECT_TIMEOUT, remaining),
+                            min(READ_TIMEOUT, remaining)))
+        delay = None
+        if HEDGE and len(pool.latencies) >= HEDGE_MIN_SAMPLES:
+            delay = pool.latencies.percentile(HEDGE_PERCENTILE)
+        try:
+            if delay is None:
+                response = attempt()
+            else:
+                response = _hedged(attempt, delay, deadline, metrics)
+        except (httplib.HTTPException, socket.error) as e:
+            if isinstance(e, socket.timeout):
+                reason = 'timeout'
+            else:
+                reason = 'error'
+            response = None
+            error = sys.exc_info()
+        else:
+            if response.status not in RETRY_STATUSES:
+                return response
+            reason = 'status'
+            error = None
+        backoff = random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2 ** retry))
+        if retry >= RETRIES or time.time() + backoff >= deadline:
+            if error:
+                raise error[0], error[1], error[2]
+            return response
+        retry += 1
+        log.warning('Retrying "%s" in %.2fs after %s (retry %d of %d)', url,
+                    backoff, error[1] if error else
+                    'status %d' % response.status, retry, RETRIES)
+        if metrics:
+            metrics.inc('http_retries_total', reason=reason)
+        time.sleep(backoff)
+
+
+def check_status(url, response, expected=(200,)):
+    """
+    Make sure that a response has one of the expected status codes.
+
+    Raises a ``urllib2.HTTPError`` otherwise.
+    """
+    if response.status not in expected:
+        raise urllib2.HTTPError(url, response.status,
+                                httplib.responses.get(response.status, ''),
+                                response.headers, None)
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+# Copyright (c) 2015 Code for Karlsruhe (http://codefor.de/karlsruhe)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Binary character classification table.
+
+The table maps character signatures (see ``scrape.get_char_signatures``)
+to characters. It is stored in a compact binary file which is generated
+by ``create_classification_table.py`` and memory-mapped on first use, so
+that loading it costs next to nothing.
+
+Besides its signature, the table stores each character's vertical
+offset within the font's character cell, which is needed for matching
+the characters as templates (see ``scrape.match_templates``), and
+whether the character can be recognized from its signature alone. That
+is not the case for characters which are not connected (e.g. ``"``) or
+whose signature is shared with another character (``'`` and ``,``).
+
+The file starts with a header consisting of the magic string ``TWGT``,
+the format version, the record size and the number of records (all
+integers big-endian). It is followed by one fixed-size record per
+character: The signature's width and height (one byte each), its bitmask
+(big-endian, ``BITS_SIZE`` bytes), the vertical offset, the flags (one
+byte each, see ``SEGMENTABLE``) and the character (one byte). The
+records are sorted, and since all fields are big-endian the byte order
+of the records is the order of their signatures, so lookups are a binary
+search over the raw records.
+"""
+
+import binascii
+import collections
+import mmap
+import struct
+import threading
+
+
+MAGIC = 'TWGT'
+VERSION = 2
+
+HEADER = struct.Struct('>4sHHI')
+
+# Size of a signature's bitmask in a record (in bytes)
+BITS_SIZE = 16
+
+# Size of the sort key (width, height and bitmask) of a record
+KEY_SIZE = 2 + BITS_SIZE
+
+RECORD_SIZE = KEY_SIZE + 3
+
+# Flag for characters which can be recognized from their signature alone
+SEGMENTABLE = 1
+
+
+# A character of the font: Its signature, its vertical offset within the
+# character cell, whether it is segmentable and the character itself.
+Glyph = collections.namedtuple('Glyph', ['signature', 'top', 'segmentable',
+                                         'char'])
+
+
+def pack_key(sig):
+    """
+    Pack a signature into the binary form used in the table.
+
+    Returns ``None`` if the signature cannot be represented, in which
+    case it is not contained in any table.
+    """
+    width, height, bits = sig
+    if not (0 <= width < 256 and 0 <= height < 256 and
+            0 <= bits < 1 << (8 * BITS_SIZE)):
+        return None
+    return (chr(width) + chr(height) +
+            binascii.unhexlify('%0*x' % (2 * BITS_SIZE, bits)))
+
+
+def unpack_key(key):
+    """
+    Unpack a signature from its binary form.
+    """
+    return ord(key[0]), ord(key[1]), int(binascii.hexlify(key[2:]), 16)
+
+
+def _unpack_record(record):
+    return Glyph(unpack_key(record[:KEY_SIZE]), ord(record[KEY_SIZE]),
+                 bool(ord(record[KEY_SIZE + 1]) & SEGMENTABLE),
+                 record[KEY_SIZE + 2])
+
+
+def write_table(filename, glyphs):
+    """
+    Write a classification table.
+
+    ``glyphs`` is an iterable of ``Glyph`` instances.
+    """
+    records = []
+    for glyph in glyphs:
+        key = pack_key(glyph.signature)
+        if key is None:
+            raise ValueError('Signature %r is too large' % (glyph.signature,))
+        if len(glyph.char) != 1:
+            raise ValueError('Invalid character %r' % glyph.char)
+        flags = SEGMENTABLE if glyph.segmentable else 0
+        records.append(key + chr(glyph.top) + chr(flags) + glyph.char)
+    records.sort()
+    with open(filename, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, RECORD_SIZE, len(records)))
+        f.write(''.join(records))
+
+
+class GlyphTable(object):
+    """
+    Read-only classification table backed by a binary table file.
+
+    The table behaves like a dictionary which maps the signatures of
+    the segmentable characters to characters, all characters are
+    available via ``glyphs``. The file is only opened when the table is
+    first used.
+    Signatures which have been found are remembered, so that repeated
+    lookups are as fast as with a dictionary. Instances can be shared
+    between threads.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._data = None
+        self._count = 0
+        self._found = {}
+        self._neighbours = {}
+        self._glyphs = None
+
+    def _load(self):
+        with self._lock:
+            if self._data is not None:
+                return
+            with open(self.filename, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                magic, version, record_size, count = HEADER.unpack(
+                        data[:HEADER.size])
+            except struct.error:
+                magic = None
+            if (magic != MAGIC or version != VERSION or
+                    record_size != RECORD_SIZE or
+                    len(data) != HEADER.size + count * RECORD_SIZE):
+                data.close()
+                raise ValueError('"%s" is not a valid classification table '
+                                 '(version %d)' % (self.filename, VERSION))
+            self._count = count
+            self._data = data
+
+    def _record(self, index):
+        offset = HEADER.size + index * RECORD_SIZE
+        return self._data[offset:offset + RECORD_SIZE]
+
+    def _bisect(self, key):
+        """
+        Get the index of the first record whose key is not less than
+        ``key``.
+        """
+        if self._data is None:
+            self._load()
+        data = self._data
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = HEADER.size + mid * RECORD_SIZE
+            if data[offset:offset + KEY_SIZE] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _segmentable(self, index):
+        offset = HEADER.size + index * RECORD_SIZE + KEY_SIZE + 1
+        return ord(self._data[offset]) & SEGMENTABLE
+
+    def __len__(self):
+        return sum(1 for glyph in self.glyphs() if glyph.segmentable)
+
+    def __getitem__(self, sig):
+        try:
+            return self._found[sig]
+        except KeyError:
+            pass
+        key = pack_key(sig)
+        if key is not None:
+            index = self._bisect(key)
+            while index < self._count:
+                record = self._record(index)
+                if record[:KEY_SIZE] != key:
+                    break
+                if self._segmentable(index):
+                    self._found[sig] = record[-1]
+                    return record[-1]
+                index += 1
+        raise KeyError(sig)
+
+    def __contains__(self, sig):
+        try:
+            self[sig]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, sig, default=None):
+        try:
+            return self[sig]
+        except KeyError:
+            return default
+
+    def glyphs(self):
+        """
+        Get all characters in the table.
+
+        Returns a list of ``Glyph`` instances in signature order.
+        """
+        if self._glyphs is None:
+            if self._data is None:
+                self._load()
+            self._glyphs = [_unpack_record(self._record(index))
+                            for index in xrange(self._count)]
+        return self._glyphs
+
+    def iteritems(self):
+        """
+        Iterate over the signatures and characters of the segmentable
+        characters in signature order.
+        """
+        for glyph in self.glyphs():
+            if glyph.segmentable:
+                yield glyph.signature, glyph.char
+
+    def itervalues(self):
+        for _, char in self.iteritems():
+            yield char
+
+    def neighbours(self, width, height):
+        """
+        Get the signatures of the segmentable characters with the given
+        dimensions.
+
+        Returns a list of 2-tuples of bitmask and character.
+        """
+        try:
+            return self._neighbours[width, height]
+        except KeyError:
+            pass
+        result = []
+        prefix = pack_key((width, height, 0))
+        if prefix is not None:
+            prefix = prefix[:2]
+            index = self._bisect(prefix)
+            while index < self._count:
+                record = self._record(index)
+                if record[:2] != prefix:
+                    break
+                if self._segmentable(index):
+                    result.append((unpack_key(record[:KEY_SIZE])[2],
+                                   record[-1]))
+                index += 1
+        self._neighbours[width, height] = result
+        return result
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+# Copyright (c) 2015 Code for Karlsruhe (http://codefor.de/karlsruhe)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Load test of the scraper.
+
+Runs many cycles of ``scrape.get_date`` and ``scrape.scrape`` on several
+threads against an image server and reports the throughput and the
+latency percentiles. By default a simulated image server (see
+``simulate``) is started in the same process, so no network access is
+required.
+"""
+
+import collections
+import logging
+import threading
+import timeit
+
+import scrape
+
+
+log = logging.getLogger('codeforka-trinkwasser.loadtest')
+
+
+# Percentiles of the durations which are reported
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, percent):
+    """
+    Get a percentile of a sorted list of values (nearest rank).
+    """
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1,
+                       int(round(percent / 100.0 * len(values))) - 1))
+    return values[index]
+
+
+def run(cycles, workers=1, concurrency=scrape.CONCURRENCY, cache=None):
+    """
+    Run a load test against ``scrape.IMAGE_URL``.
+
+    ``cycles`` cycles of ``scrape.get_date`` and ``scrape.scrape`` are
+    run on ``workers`` threads. ``concurrency`` and ``cache`` are passed
+    on to ``scrape.scrape``.
+
+    Failed cycles are logged. Returns a dictionary with the total run
+    time in seconds (``elapsed``), the number of failed cycles
+    (``errors``), a ``collections.Counter`` of their exception types
+    (``failures``) and sorted lists of the durations of the successful
+    ``date``, ``values`` and complete (``cycle``) steps in seconds.
+    """
+    lock = threading.Lock()
+    remaining = [cycles]
+    results = {'errors': 0, 'failures': collections.Counter(), 'date': [],
+               'values': [], 'cycle': []}
+
+    def worker():
+        while True:
+            with lock:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+            try:
+                start = timeit.default_timer()
+                scrape.get_date(cache)
+                middle = timeit.default_timer()
+                scrape.scrape(concurrency, cache)
+                end = timeit.default_timer()
+            except Exception as e:
+                log.warning('Cycle failed: %s', e, exc_info=True)
+                with lock:
+                    results['errors'] += 1
+                    results['failures'][e.__class__.__name__] += 1
+                continue
+            with lock:
+                results['date'].append(middle - start)
+                results['values'].append(end - middle)
+                results['cycle'].append(end - start)
+
+    threads = [threading.Thread(target=worker) for _ in xrange(workers)]
+    start = timeit.default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results['elapsed'] = timeit.default_timer() - start
+    for key in ('date', 'values', 'cycle'):
+        results[key].sort()
+    return results
+
+
+def format_report(results):
+    """
+    Format the results of ``run`` as a human-readable report.
+    """
+    cycles = len(results['cycle']) + results['errors']
+    elapsed = results['elapsed']
+    requests = len(results['cycle']) * (len(scrape.VALUES) + 1)
+    lines = [
+        'Cycles:     %d (%d failed)' % (cycles, results['errors']),
+        'Time:       %.2f s' % elapsed,
+        'Throughput: %.1f cycles/s, %.1f images/s' % (
+                     len(results['cycle']) / elapsed, requests / elapsed),
+    ]
+    for name, count in results['failures'].most_common():
+        lines.append('Failures:   %d x %s' % (count, name))
+    lines += [
+        '',
+        '%-8s %s %10s' % ('', ' '.join('%10s' % ('p%d' % p) for p in PERCENTILES),
+                          'max'),
+    ]
+    for key in ('date', 'values', 'cycle'):
+        values = results[key]
+        if not values:
+            continue
+        lines.append('%-8s %s %10s' % (key, ' '.join(
+                '%7.1f ms' % (1000 * percentile(values, p)) for p in PERCENTILES),
+                '%7.1f ms' % (1000 * values[-1])))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    import fetch
+    import simulate
+    from cache import ImageCache
+    from serve import make_server
+
+    parser = argparse.ArgumentParser(
+            description=__doc__.strip().split('\n', 1)[0])
+    parser.add_argument('--cycles', type=int, default=100,
+                        help='Number of scrape cycles (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of cycles run in parallel ' +
+                             '(default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=scrape.CONCURRENCY,
+                        help='Maximum number of parallel downloads per ' +
+                             'cycle (default: %(default)s)')
+    parser.add_argument('--cache', metavar='FILE',
+                        help='Use an image cache stored in this file')
+    parser.add_argument('--hedge', action='store_true',
+                        help='Send hedged requests for slow downloads')
+    parser.add_argument('--url', help='URL template of an image server ' +
+                        '(default: start a simulated server)')
+    group = parser.add_argument_group('simulated server')
+    group.add_argument('--latency', type=float, default=0,
+                       help='Mean response delay in seconds ' +
+                            '(default: %(default)s)')
+    group.add_argument('--error-rate', type=float, default=0,
+                       help='Share of requests that fail ' +
+                            '(default: %(default)s)')
+    group.add_argument('--drift', type=float, default=0.01,
+                       help='Relative standard deviation of the value ' +
+                            'changes (default: %(default)s)')
+    group.add_argument('--interval', type=float, default=60,
+                       help='Seconds between measurements ' +
+                            '(default: %(default)s)')
+    group.add_argument('--seed', type=int, help='Random seed')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING,
+                        format='%(asctime)s %(levelname)s: %(message)s')
+    fetch.HEDGE = args.hedge
+    cache = None
+    if args.cache:
+        cache = ImageCache(args.cache, version=scrape.ocr_version())
+
+    simulator = None
+    if args.url:
+        scrape.IMAGE_URL = args.url
+    else:
+        simulator = simulate.Simulator(args.latency, args.error_rate,
+                                       args.drift, args.interval, args.seed)
+        server = make_server(simulator)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        scrape.IMAGE_URL = simulate.image_url(server)
+
+    results = run(args.cycles, args.workers, args.concurrency, cache)
+    print format_report(results)
+    if simulator:
+        print
+        print 'Server:     %d requests (%d failed)' % (simulator.requests,
+                                                        simulator.errors)
+    if cache:
+        cache.save()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+# Copyright (c) 2015 Code for Karlsruhe (http://codefor.de/karlsruhe)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Inter-process locks based on lock files.
+
+A lock is held by the process which created its lock file. The file
+contains the holder's process ID, host name and the time at which the
+lock was acquired, so that locks left behind by crashed processes can be
+detected and broken: A lock is stale if its holder runs on the same host
+and no longer exists. Since that cannot be checked for holders on other
+hosts, their locks are considered stale once they are older than the
+stale timeout.
+"""
+
+import binascii
+import errno
+import json
+import os
+import os.path
+import socket
+import threading
+import time
+
+
+# Age after which a lock whose holder cannot be checked (because it runs
+# on another host) is considered stale (in seconds)
+STALE_TIMEOUT = 30 * 60
+
+# Delay between attempts to acquire a lock that is held elsewhere (in
+# seconds)
+POLL_INTERVAL = 0.2
+
+
+class LockTimeout(Exception):
+    """
+    Raised if a lock cannot be acquired in time.
+    """
+
+
+def _random_token():
+    # Like ``uuid.uuid4().hex``, without the slow import of ``uuid``
+    return binascii.hexlify(os.urandom(16))
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class FileLock(object):
+    """
+    A lock which is represented by a file.
+
+    ``filename`` is the name of the lock file. Locks held by processes
+    on the same host are broken once the process has ended, other locks
+    once they are older than ``stale_timeout`` seconds. Instances can be
+    used as context managers and can be shared between threads, but the
+    lock is not reentrant.
+    """
+
+    def __init__(self, filename, stale_timeout=STALE_TIMEOUT):
+        self.filename = filename
+        self.stale_timeout = stale_timeout
+        self._token = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<FileLock %r>' % self.filename
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def _read(self, filename):
+        """
+        Read the content of a lock file.
+
+        Returns ``None`` if the file does not exist. Incomplete content
+        (the holder may be writing it) is returned as an empty
+        dictionary.
+        """
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            return json.loads(data)
+        except ValueError:
+            return {}
+
+    def _is_stale(self, info):
+        if (info.get('host') == socket.gethostname() and
+                isinstance(info.get('pid'), int)):
+            # A live holder keeps its lock however long it takes
+            return not _process_exists(info['pid'])
+        try:
+            age = time.time() - os.stat(self.filename).st_mtime
+        except OSError:
+            return False
+        return age > self.stale_timeout
+
+    def _break(self, info):
+        """
+        Remove a stale lock file.
+
+        The file is first renamed, which only one process can succeed
+        at. If it turns out that the file has been replaced by a new lock
+        in the meantime then it is restored.
+        """
+        temp = '%s.%s.stale' % (self.filename, _random_token())
+        try:
+            os.rename(self.filename, temp)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        if self._read(temp) != info:
+            try:
+                os.link(temp, self.filename)
+            except OSError:
+                pass
+        os.remove(temp)
+
+    def _try_acquire(self):
+        token = _random_token()
+        try:
+            fd = os.open(self.filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0644)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            info = self._read(self.filename)
+            if info is not None and self._is_stale(info):
+                self._break(info)
+            return False
+        with os.fdopen(fd, 'wb') as f:
+            json.dump({'pid': os.getpid(), 'host': socket.gethostname(),
+                       'time': time.time(), 'token': token}, f)
+        self._token = token
+        return True
+
+    def acquire(self, timeout=None):
+        """
+        Acquire the lock.
+
+        Blocks until the lock is acquired or until ``timeout`` seconds
+        have passed, in which case ``LockTimeout`` is raised. If
+        ``timeout`` is ``None`` then there is no time limit, if it is
+        zero then this does not block.
+        """
+        start = time.time()
+        if not self._lock.acquire(False):
+            while not self._lock.acquire(False):
+                if timeout is not None and time.time() - start >= timeout:
+                    raise LockTimeout('Lock "%s" is held by another thread' %
+                                      self.filename)
+                time.sleep(POLL_INTERVAL)
+        try:
+            while not self._try_acquire():
+                if timeout is not None and time.time() - start >= timeout:
+                    raise LockTimeout('Lock "%s" is held by another process' %
+                                      self.filename)
+                time.sleep(POLL_INTERVAL)
+        except:
+            self._lock.release()
+            raise
+
+    def release(self):
+        """
+        Release the lock.
+
+        The lock file is only removed if it still belongs to this lock
+        (and has not been broken as stale by another process).
+        """
+        try:
+            info = self._read(self.filename)
+            if info and info.get('token') == self._token:
+                os.remove(self.filename)
+        finally:
+            self._token = None
+            self._lock.release()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+# Copyright (c) 2015 Code for Karlsruhe (http://codefor.de/karlsruhe)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Run-time metrics of the scraper.
+
+Metrics are identified by a name and optional labels. Three kinds are
+supported: counters, gauges and summaries (a sum and a count, e.g. of
+durations). They can be formatted as a single structured log line and
+written to a file in the Prometheus text exposition format, e.g. for
+the textfile collector of the Prometheus node exporter.
+"""
+
+import contextlib
+import os
+import os.path
+import tempfile
+import threading
+import timeit
+
+
+# Prefix of the metric names in the Prometheus output
+PREFIX = 'trinkwasser_'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', r'\\')
+                                                         .replace('"', r'\"'))
+                             for name, value in labels)
+
+
+class Metrics(object):
+    """
+    Collection of metrics.
+
+    Values accumulate over the lifetime of the instance. Instances can
+    be shared between threads.
+    """
+
+    def __init__(self, prefix=PREFIX):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._types = {}
+        self._values = {}
+
+    def _add(self, kind, name, labels, suffix, amount):
+        key = (name + suffix, tuple(sorted(labels.iteritems())))
+        with self._lock:
+            self._types.setdefault(name, kind)
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def inc(self, name, amount=1, **labels):
+        """
+        Increase a counter.
+        """
+        self._add('counter', name, labels, '', amount)
+
+    def set(self, name, value, **labels):
+        """
+        Set a gauge.
+        """
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self._lock:
+            self._types.setdefault(name, 'gauge')
+            self._values[key] = value
+
+    def observe(self, name, value, **labels):
+        """
+        Add an observation (e.g. a duration) to a summary.
+        """
+        self._add('summary', name, labels, '_sum', value)
+        self._add('summary', name, labels, '_count', 1)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """
+        Context manager which adds its run time to a summary.
+        """
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            self.observe(name, timeit.default_timer() - start, **labels)
+
+    def snapshot(self):
+        """
+        Get the current values.
+
+        Returns a dictionary which maps 2-tuples of name and labels to
+        values. The labels are a sorted tuple of 2-tuples of label name
+        and value.
+        """
+        with self._lock:
+            return dict(self._values)
+
+    def format(self, since=None):
+        """
+        Format the metrics as a single log line.
+
+        The line consists of ``key=value`` pairs, where the key is the
+        metric name followed by its label values, separated by dots.
+        If ``since`` is a snapshot (see ``snapshot``) then counters and
+        summaries only include the changes since then.
+        """
+        pairs = []
+        for (name, labels), value in sorted(self.snapshot().iteritems()):
+            if since is not None and self._types.get(name) != 'gauge':
+                value -= since.get((name, labels), 0)
+                if not value:
+                    continue
+            if isinstance(value, float):
+                value = '%.6f' % value
+            key = '.'.join([name] + [str(v) for _, v in labels])
+            pairs.append('%s=%s' % (key, value))
+        return ' '.join(pairs)
+
+    def write_textfile(self, filename):
+        """
+        Write the metrics in the Prometheus text exposition format.
+
+        The file is replaced atomically so that it is never read while
+        incomplete.
+        """
+        values = self.snapshot()
+        with self._lock:
+            types = dict(self._types)
+        lines = []
+        for name, kind in sorted(types.iteritems()):
+            lines.append('# TYPE %s%s %s' % (self.prefix, name, kind))
+            for (key, labels), value in sorted(values.iteritems()):
+                if key == name or (kind == 'summary' and
+                                   key in (name + '_sum', name + '_count')):
+                    lines.append('%s%s%s %s' % (self.prefix, key,
+                                 _format_labels(labels), _format_value(value)))
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, temp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.chmod(temp, 0644)
+            os.rename(temp, filename)
+        except:
+            os.remove(temp)
+            raise
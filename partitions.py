@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+# Copyright (c) 2015 Code for Karlsruhe (http://codefor.de/karlsruhe)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Partitioned storage of measurements in a JSON directory.
+
+Instead of one JSON file per measurement, the measurements of one day
+or one month (a partition) are stored in a single file with one JSON
+object per line, e.g. ``karlsruhe-drinking-water-2015-09-21.ndjson``.
+Each object has the same format as the individual JSON files. Once a
+newer partition has been started, older ones can be compressed using
+gzip (``.ndjson.gz``).
+
+``latest.json`` is kept up to date as a regular file containing the most
+recent measurement.
+"""
+
+import collections
+import cStringIO
+import errno
+import glob
+import gzip
+import json
+import os
+import os.path
+import struct
+import threading
+import zlib
+
+from store import JSON_LATEST, JSON_PREFIX, JSON_SUFFIX, read_json, write_atomic
+
+
+# Length of the date prefix which identifies a partition, by period
+PERIODS = collections.OrderedDict([('day', 10), ('month', 7)])
+
+PARTITION_SUFFIX = '.ndjson'
+COMPRESSED_SUFFIX = PARTITION_SUFFIX + '.gz'
+
+# Maximum number of partition files whose dates are remembered by
+# ``has_measurement``
+MAX_CACHED_FILES = 16
+
+# Maps partition file names to 5-tuples of file identity, size and
+# modification time, the set of stored dates and the offset up to which
+# the file has been read (see ``_stored_dates``)
+_dates = {}
+_dates_lock = threading.Lock()
+
+
+def partition_key(date, period='day'):
+    """
+    Get the key of the partition to which a measurement date belongs.
+    """
+    return date[:PERIODS[period]]
+
+
+def partition_filename(directory, key, compressed=False):
+    """
+    Get the name of a partition file.
+    """
+    suffix = COMPRESSED_SUFFIX if compressed else PARTITION_SUFFIX
+    return os.path.join(directory, JSON_PREFIX + key + suffix)
+
+
+def list_partitions(directory):
+    """
+    List the partitions in a directory.
+
+    Returns a sorted list of 2-tuples of partition key and the list of
+    the partition's files (an uncompressed and a compressed one may
+    exist at the same time if compressing was interrupted).
+    """
+    partitions = collections.defaultdict(list)
+    for suffix in (PARTITION_SUFFIX, COMPRESSED_SUFFIX):
+        pattern = os.path.join(directory, JSON_PREFIX + '*' + suffix)
+        for filename in glob.glob(pattern):
+            key = os.path.basename(filename)[len(JSON_PREFIX):-len(suffix)]
+            partitions[key].append(filename)
+    return sorted(partitions.iteritems())
+
+
+def partition_files(directory, key):
+    """
+    Get the existing files of a partition.
+    """
+    filenames = [partition_filename(directory, key, compressed)
+                 for compressed in (False, True)]
+    return [filename for filename in filenames if os.path.exists(filename)]
+
+
+def _open(filename, mode='rb'):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+
+def read_partition(filenames):
+    """
+    Load the measurements of a partition.
+
+    ``filenames`` is the list of the partition's files. Lines which are
+    not valid JSON (e.g. an incomplete last line after a crash) are
+    skipped, and so is the rest of a compressed file after corrupt
+    data. If a date occurs more than once then the last occurrence wins.
+
+    Returns an ordered dictionary which maps dates to values in
+    chronological order.
+    """
+    measurements = {}
+    for filename in filenames:
+        with _open(filename) as f:
+            try:
+                for line in f:
+                    try:
+                        data = json.loads(line.decode('utf8'))
+                    except ValueError:
+                        continue
+                    measurements[data['date']] = data['values']
+            except (IOError, EOFError, struct.error, zlib.error):
+                pass
+    return collections.OrderedDict(sorted(measurements.iteritems()))
+
+
+def _dump(date, values):
+    return json.dumps({'date': date, 'values': values},
+                      separators=(',', ':')).encode('utf8') + '\n'
+
+
+def _compress(data):
+    buf = cStringIO.StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def _remove(filename):
+    try:
+        os.remove(filename)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def write_partition(directory, key, measurements, compress=False):
+    """
+    Replace the content of a partition.
+
+    ``measurements`` maps dates to values. Existing files of the
+    partition are replaced by a single (compressed if ``compress`` is
+    true) one.
+    """
+    data = ''.join(_dump(date, values)
+                   for date, values in sorted(measurements.iteritems()))
+    if compress:
+        data = _compress(data)
+    write_atomic(partition_filename(directory, key, compress), data)
+    _remove(partition_filename(directory, key, not compress))
+
+
+def compress_partition(directory, key):
+    """
+    Compress a partition.
+    """
+    measurements = read_partition(partition_files(directory, key))
+    write_partition(directory, key, measurements, compress=True)
+
+
+def write_latest(directory, date, values):
+    """
+    Store a measurement as ``latest.json``.
+
+    ``latest.json`` is replaced by a regular file (it is a symlink if the
+    measurements are stored as individual files).
+    """
+    data = json.dumps({'date': date, 'values': values}, separators=(',', ':'))
+    write_atomic(os.path.join(directory, JSON_LATEST), data.encode('utf8'))
+
+
+def _read_dates(filename, offset, dates):
+    """
+    Add the dates of the complete lines after an offset to a set.
+
+    Returns the offset after the last complete line.
+    """
+    with open(filename, 'rb') as f:
+        if offset:
+            # Make sure that the offset is still at the start of a line
+            f.seek(offset - 1)
+            if f.read(1) != '\n':
+                dates.clear()
+                f.seek(0)
+                offset = 0
+        data = f.read()
+    end = data.rfind('\n') + 1
+    for line in data[:end].splitlines():
+        try:
+            dates.add(json.loads(line.decode('utf8'))['date'])
+        except (ValueError, KeyError, TypeError):
+            continue
+    return offset + end
+
+
+def _stored_dates(filename):
+    """
+    Get the dates of the measurements stored in a partition file.
+
+    The dates are remembered. If an uncompressed file has only grown
+    since then only the appended lines are read.
+    """
+    stat = os.stat(filename)
+    identity = (stat.st_dev, stat.st_ino)
+    with _dates_lock:
+        cached = _dates.get(filename)
+        if cached and cached[:3] == (identity, stat.st_size, stat.st_mtime):
+            return cached[3]
+        if filename.endswith('.gz'):
+            dates = set(read_partition([filename]))
+            offset = None
+        else:
+            offset = 0
+            dates = set()
+            if cached and cached[0] == identity and cached[1] < stat.st_size:
+                offset = cached[4]
+                dates = set(cached[3])
+            offset = _read_dates(filename, offset, dates)
+        if len(_dates) >= MAX_CACHED_FILES:
+            _dates.clear()
+        _dates[filename] = (identity, stat.st_size, stat.st_mtime, dates, offset)
+        return dates
+
+
+def has_measurement(directory, date, period='day'):
+    """
+    Check whether a measurement is stored in a partition.
+
+    The dates stored in the partition's files are remembered, so that
+    repeated checks only read what has been appended since.
+    """
+    for filename in partition_files(directory, partition_key(date, period)):
+        try:
+            if date in _stored_dates(filename):
+                return True
+        except OSError as e:
+            # Removed meanwhile, e.g. because it has been compressed
+            if e.errno != errno.ENOENT:
+                raise
+    return False
+
+
+def append_measurement(directory, date, values, period='day', compress=False,
+                       latest=True):
+    """
+    Append a measurement to its partition.
+
+    ``date`` is the measurement date and ``values`` is a dictionary of
+    values as returned by ``scrape.scrape``. If ``compress`` is true
+    then all uncompressed partitions older than the measurement's one
+    are compressed. If ``latest`` is true then ``latest.json`` is
+    updated unless it contains a more recent measurement.
+    """
+    key = partition_key(date, period)
+    if os.path.exists(partition_filename(directory, key, True)):
+        # Late measurement for a closed partition, which is rewritten
+        measurements = read_partition(partition_files(directory, key))
+        measurements[date] = values
+        write_partition(directory, key, measurements, compress=True)
+    else:
+        filename = partition_filename(directory, key)
+        with open(filename, 'ab') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell():
+                # Make sure that an incomplete line left by a crash does
+                # not swallow the new one
+                with open(filename, 'rb') as g:
+                    g.seek(-1, os.SEEK_END)
+                    if g.read(1) != '\n':
+                        f.write('\n')
+            f.write(_dump(date, values))
+    if compress:
+        for other, filenames in list_partitions(directory):
+            if other < key and any(not filename.endswith('.gz')
+                                   for filename in filenames):
+                compress_partition(directory, other)
+    if latest:
+        try:
+            current = read_json(os.path.join(directory, JSON_LATEST))[0]
+        except (IOError, ValueError, KeyError):
+            current = None
+        if current is None or current <= date:
+            write_latest(directory, date, values)
+
+
+def iter_partitions(directory, start=None, end=None):
+    """
+    Iterate over the measurements stored in the partitions of a
+    directory.
+
+    ``start`` (inclusive) and ``end`` (exclusive) are measurement dates.
+    If they are ``None`` then the range is unbounded. Only the
+    partitions which overlap the range are read, one at a time.
+
+    Yields 2-tuples of measurement date and dictionary of values in
+    chronological order.
+    """
+    for key, filenames in list_partitions(directory):
+        if start is not None and key < start[:len(key)]:
+            continue
+        if end is not None and key > end[:len(key)]:
+            break
+        for date, values in read_partition(filenames).iteritems():
+            if start is not None and date < start:
+                continue
+            if end is not None and date >= end:
+                return
+            yield date, values
+
+
+def compact(directory, period='day', compress=False):
+    """
+    Move the individual JSON files of a directory into partitions.
+
+    The measurements of the JSON files are merged into the existing
+    partitions, then the files are removed. If ``compress`` is true
+    then all partitions except the most recent one are compressed.
+    ``latest.json`` is replaced by a regular file.
+
+    Returns the number of moved measurements.
+    """
+    pending = collections.defaultdict(dict)
+    filenames = []
+    pattern = os.path.join(directory, JSON_PREFIX + '*' + JSON_SUFFIX)
+    for filename in sorted(glob.glob(pattern)):
+        date, values = read_json(filename)
+        pending[partition_key(date, period)][date] = values
+        filenames.append(filename)
+    partitions = dict(list_partitions(directory))
+    keys = sorted(set(partitions) | set(pending))
+    for key in keys:
+        files = partitions.get(key, [])
+        compressed = partition_filename(directory, key, True)
+        # Partitions which are already compressed stay compressed
+        should_compress = (compress and key != keys[-1]) or compressed in files
+        if key not in pending and (not should_compress or files == [compressed]):
+            continue
+        measurements = read_partition(files)
+        measurements.update(pending.get(key, {}))
+        write_partition(directory, key, measurements, should_compress)
+    if keys:
+        measurements = read_partition(partition_files(directory, keys[-1]))
+        if measurements:
+            write_latest(directory, *measurements.popitem())
+    for filename in filenames:
+        os.remove(filename)
+    return len(filenames)
+
+
+if __name__ == '__main__':
+    import argparse
+    import sys
+
+    from lock import FileLock
+    from store import JSON_LOCK
+
+    parser = argparse.ArgumentParser(
+            description=__doc__.strip().split('\n', 1)[0])
+    parser.add_argument('directory', help='JSON directory')
+    subparsers = parser.add_subparsers(dest='command')
+    compact_parser = subparsers.add_parser(
+            'compact', help='Move individual JSON files into partitions')
+    compact_parser.add_argument('--period', choices=PERIODS, default='day',
+                                help='Partition period (default: %(default)s)')
+    compact_parser.add_argument('--compress', action='store_true',
+                                help='Compress all but the latest partition')
+    read_parser = subparsers.add_parser(
+            'read', help='Print the measurements as newline-delimited JSON')
+    read_parser.add_argument('--from', dest='start',
+                             help='First date (inclusive)')
+    read_parser.add_argument('--to', dest='end', help='Last date (exclusive)')
+    args = parser.parse_args()
+
+    if args.command == 'compact':
+        with FileLock(os.path.join(args.directory, JSON_LOCK)):
+            count = compact(args.directory, args.period, args.compress)
+        print 'Moved %d measurements into partitions.' % count
+    elif args.command == 'read':
+        for date, values in iter_partitions(args.directory, args.start, args.end):
+            sys.stdout.write(_dump(date, values))
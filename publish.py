@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+# Copyright (c) 2015 Code for Karlsruhe (http://codefor.de/karlsruhe)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Push notifications for new measurements.
+
+Each newly stored measurement can be pushed to subscribers instead of
+them having to poll ``latest.json``: It is sent via HTTP POST to
+webhooks and as a Server-Sent Event to the clients of an event stream.
+The payload is the same JSON object that is stored in the output files.
+
+Delivery happens in the background, so a slow or unreachable subscriber
+never delays the scraper. Each subscriber has its own bounded queue of
+undelivered measurements, which are delivered in order and retried with
+exponential backoff.
+"""
+
+import collections
+import heapq
+import httplib
+import itertools
+import json
+import logging
+import Queue
+import socket
+import threading
+import time
+import urlparse
+
+
+log = logging.getLogger('codeforka-trinkwasser.publish')
+
+# Maximum number of undelivered measurements per subscriber. If more
+# arrive then the oldest ones are dropped.
+QUEUE_SIZE = 100
+
+# Maximum number of simultaneous webhook requests
+CONCURRENCY = 4
+
+# Timeout for webhook requests (in seconds)
+TIMEOUT = 10
+
+# Maximum number of attempts to deliver a measurement to a webhook and
+# initial and maximum delay between them (in seconds)
+MAX_ATTEMPTS = 5
+BACKOFF = 1
+MAX_BACKOFF = 300
+
+# Interval of the keep-alive comments in event streams (in seconds)
+KEEPALIVE_INTERVAL = 15
+
+# Number of recent events which are sent to reconnecting stream clients
+HISTORY_SIZE = 10
+
+# Maximum time to wait for pending deliveries when closing a publisher
+# (in seconds)
+CLOSE_TIMEOUT = 30
+
+
+def format_payload(date, values):
+    """
+    Format a measurement as JSON like the output files.
+    """
+    return json.dumps({'date': date, 'values': values},
+                      separators=(',', ':')).encode('utf8')
+
+
+def _utf8(s):
+    """
+    Encode a unicode string as UTF-8.
+
+    Byte strings and ``None`` are returned unchanged.
+    """
+    if isinstance(s, unicode):
+        return s.encode('utf8')
+    return s
+
+
+def event_id(date, source=None):
+    """
+    Get the ID of the event for a measurement.
+
+    The ID consists of the measurement date and, if given, the source
+    name, separated by a slash, so that it is unique even if several
+    sources publish measurements with the same date. It is returned as
+    a UTF-8 encoded byte string.
+    """
+    if source is None:
+        return _utf8(date)
+    return '%s/%s' % (_utf8(date), _utf8(source))
+
+
+class DeliveryError(Exception):
+    """
+    A webhook request has failed.
+    """
+
+
+class Webhook(object):
+    """
+    A webhook subscriber.
+
+    Measurements are sent to ``url`` via HTTP POST with the name of the
+    source in the ``X-Source`` header. Any response status other than
+    2xx counts as a failure.
+    """
+
+    def __init__(self, url, queue_size=QUEUE_SIZE, timeout=TIMEOUT):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError('Invalid webhook URL "%s"' % url)
+        self.url = url
+        self.timeout = timeout
+        # Undelivered measurements, number of failed attempts for the
+        # first one and whether a delivery is scheduled (managed by
+        # ``Publisher``)
+        self.queue = collections.deque(maxlen=queue_size)
+        self.attempts = 0
+        self.scheduled = False
+
+    def __repr__(self):
+        return '<Webhook %r>' % self.url
+
+    def deliver(self, payload, source=None):
+        """
+        Send a payload.
+
+        Raises ``DeliveryError`` if the request fails.
+        """
+        parts = urlparse.urlsplit(self.url)
+        if parts.scheme == 'https':
+            conn = httplib.HTTPSConnection(parts.hostname, parts.port,
+                                           timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(parts.hostname, parts.port,
+                                          timeout=self.timeout)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        headers = {'Content-Type': 'application/json'}
+        if source:
+            headers['X-Source'] = _utf8(source)
+        try:
+            conn.request('POST', path, payload, headers)
+            response = conn.getresponse()
+            response.read()
+        except (httplib.HTTPException, socket.error) as e:
+            raise DeliveryError(str(e) or e.__class__.__name__)
+        finally:
+            conn.close()
+        if not 200 <= response.status < 300:
+            raise DeliveryError('Status %d' % response.status)
+
+
+class EventStream(object):
+    """
+    WSGI application which streams measurements as Server-Sent Events.
+
+    Each event's ID is made up of the measurement date and the source
+    name (see ``event_id``) and its data is the payload. Clients can
+    restrict the stream to one source via the query parameter
+    ``source``. Reconnecting clients which send a ``Last-Event-ID``
+    header first receive the recent events they have missed.
+
+    Each client has its own queue of up to ``queue_size`` events. If a
+    client does not keep up then its oldest events are dropped.
+    """
+
+    def __init__(self, queue_size=QUEUE_SIZE, keepalive=KEEPALIVE_INTERVAL,
+                 metrics=None):
+        self.queue_size = queue_size
+        self.keepalive = keepalive
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._clients = set()
+        self._history = collections.deque(maxlen=HISTORY_SIZE)
+
+    @property
+    def clients(self):
+        """
+        The number of connected clients.
+        """
+        return len(self._clients)
+
+    def publish(self, date, payload, source=None):
+        """
+        Send an event to all clients.
+        """
+        # Source names from a configuration file are unicode, but WSGI
+        # responses must consist of byte strings
+        event = (event_id(date, source), date, _utf8(payload), _utf8(source))
+        with self._lock:
+            self._history.append(event)
+            clients = list(self._clients)
+        for queue in clients:
+            while True:
+                try:
+                    queue.put_nowait(event)
+                    break
+                except Queue.Full:
+                    try:
+                        queue.get_nowait()
+                    except Queue.Empty:
+                        pass
+                    if self.metrics:
+                        self.metrics.inc('pushes_total', channel='sse',
+                                         result='dropped')
+
+    def __call__(self, environ, start_response):
+        params = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+        source = params.get('source', [None])[0]
+        last_id = environ.get('HTTP_LAST_EVENT_ID')
+        start_response('200 OK', [('Content-Type', 'text/event-stream'),
+                                  ('Cache-Control', 'no-cache')])
+        return self._stream(source, last_id)
+
+    def _missed(self, history, last_id):
+        """
+        Get the events of the history which follow the given one.
+        """
+        ids = [event[0] for event in history]
+        if last_id in ids:
+            return history[ids.index(last_id) + 1:]
+        # The event is no longer in the history (or it was sent before a
+        # restart), so fall back to the measurement dates
+        last_date = last_id.split('/', 1)[0]
+        return [event for event in history if event[1] > last_date]
+
+    def _stream(self, source, last_id):
+        queue = Queue.Queue(self.queue_size)
+        with self._lock:
+            # The client is registered and the history is copied at the
+            # same time, so that each event is either in the copy or put
+            # into the queue. Registering only once the response is
+            # iterated makes sure that the ``finally`` clause runs.
+            self._clients.add(queue)
+            history = list(self._history)
+        try:
+            yield ': connected\n\n'
+            events = []
+            if last_id is not None:
+                events = self._missed(history, last_id)
+            while True:
+                if events:
+                    event = events.pop(0)
+                else:
+                    try:
+                        event = queue.get(timeout=self.keepalive)
+                    except Queue.Empty:
+                        yield ': keep-alive\n\n'
+                        continue
+                id, date, payload, event_source = event
+                if source not in (None, event_source):
+                    continue
+                yield 'id: %s\ndata: %s\n\n' % (id, payload)
+                if self.metrics:
+                    self.metrics.inc('pushes_total', channel='sse',
+                                     result='delivered')
+        finally:
+            with self._lock:
+                self._clients.discard(queue)
+
+
+class Publisher(object):
+    """
+    Fan-out of new measurements to subscribers.
+
+    ``webhooks`` is a list of ``Webhook`` instances and ``stream`` an
+    optional ``EventStream``. Webhook requests are sent by a pool of
+    ``concurrency`` background threads, at most one at a time per
+    webhook. Failed deliveries are retried with exponential backoff (see
+    ``MAX_ATTEMPTS``, ``BACKOFF`` and ``MAX_BACKOFF``) without occupying
+    a thread. If ``metrics`` is a ``metrics.Metrics`` instance then the
+    outcomes are counted.
+    """
+
+    def __init__(self, webhooks=(), stream=None, concurrency=CONCURRENCY,
+                 metrics=None):
+        self.webhooks = list(webhooks)
+        self.stream = stream
+        self.metrics = metrics
+        self._cond = threading.Condition()
+        # Heap of 3-tuples of time of the next delivery attempt, sequence
+        # number and webhook
+        self._due = []
+        self._counter = itertools.count()
+        self._busy = 0
+        self._stopped = False
+        self._threads = []
+        for _ in xrange(concurrency if self.webhooks else 0):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _count(self, channel, result):
+        if self.metrics:
+            self.metrics.inc('pushes_total', channel=channel, result=result)
+
+    def _schedule(self, webhook, when):
+        heapq.heappush(self._due, (when, next(self._counter), webhook))
+        webhook.scheduled = True
+
+    def publish(self, date, values, source=None):
+        """
+        Push a measurement to all subscribers.
+
+        ``date`` is the measurement date, ``values`` is a dictionary of
+        values as returned by ``scrape.scrape`` and ``source`` is the
+        name of the source. Returns immediately.
+        """
+        payload = format_payload(date, values)
+        if self.stream:
+            self.stream.publish(date, payload, source)
+        with self._cond:
+            for webhook in self.webhooks:
+                if len(webhook.queue) == webhook.queue.maxlen:
+                    log.warning('Dropping measurement for %s, queue is full',
+                                webhook.url)
+                    self._count('webhook', 'dropped')
+                    webhook.attempts = 0
+                # Entries are wrapped in a list so that they can be
+                # told apart by identity
+                webhook.queue.append([payload, source])
+                if not webhook.scheduled:
+                    self._schedule(webhook, time.time())
+            self._cond.notify_all()
+
+    def _next(self):
+        """
+        Wait for the next due delivery.
+
+        Returns the webhook and its first queue entry or ``None`` if the
+        publisher has been closed.
+        """
+        with self._cond:
+            while not self._stopped:
+                now = time.time()
+                if self._due and self._due[0][0] <= now:
+                    webhook = heapq.heappop(self._due)[2]
+                    self._busy += 1
+                    return webhook, webhook.queue[0]
+                self._cond.wait(self._due[0][0] - now if self._due else None)
+        return None
+
+    def _work(self):
+        while True:
+            task = self._next()
+            if task is None:
+                return
+            webhook, entry = task
+            try:
+                webhook.deliver(*entry)
+                error = None
+            except Exception as e:
+                error = e
+            with self._cond:
+                self._busy -= 1
+                delay = 0
+                if error is None:
+                    self._count('webhook', 'delivered')
+                    webhook.attempts = 0
+                elif webhook.attempts + 1 >= MAX_ATTEMPTS:
+                    log.error('Giving up delivery to %s after %d attempts: %s',
+                              webhook.url, MAX_ATTEMPTS, error)
+                    self._count('webhook', 'failed')
+                    webhook.attempts = 0
+                else:
+                    webhook.attempts += 1
+                    delay = min(MAX_BACKOFF,
+                                BACKOFF * 2 ** (webhook.attempts - 1))
+                    log.warning('Delivery to %s failed, retrying in %ds: %s',
+                                webhook.url, delay, error)
+                    self._count('webhook', 'retried')
+                    entry = None
+                # The entry may have been dropped from a full queue
+                if (entry is not None and webhook.queue and
+                        webhook.queue[0] is entry):
+                    webhook.queue.popleft()
+                if webhook.queue:
+                    self._schedule(webhook, time.time() + delay)
+                else:
+                    webhook.scheduled = False
+                self._cond.notify_all()
+
+    def pending(self):
+        """
+        Get the number of undelivered webhook requests.
+        """
+        with self._cond:
+            return sum(len(webhook.queue) for webhook in self.webhooks)
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        """
+        Wait for pending deliveries and stop the background threads.
+
+        Waits at most ``timeout`` seconds. Returns the number of
+        measurements which could not be delivered in time.
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._threads and (self._busy or any(
+                    webhook.queue for webhook in self.webhooks)):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            undelivered = sum(len(webhook.queue) for webhook in self.webhooks)
+            self._stopped = True
+            self._cond.notify_all()
+        if undelivered:
+            log.warning('%d webhook deliveries are still pending', undelivered)
+        return undelivered
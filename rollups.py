@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+# Copyright (c) 2015 Code for Karlsruhe (http://codefor.de/karlsruhe)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Aggregated values of the indicators.
+
+For each indicator the number of values, their minimum, maximum, mean
+and the most recent value are maintained per hour, day and month in an
+SQLite database. The aggregates are updated incrementally whenever a new
+measurement is stored, so that long-term trends can be queried without
+reading the individual measurements. Existing measurements can be
+aggregated using ``Rollups.rebuild``.
+"""
+
+import collections
+
+from store import _text
+
+
+# Length of the date prefix which identifies a bucket, by period
+PERIODS = collections.OrderedDict([('hour', 13), ('day', 10), ('month', 7)])
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS rollups (
+    period TEXT NOT NULL,
+    indicator TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    total REAL NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    last REAL NOT NULL,
+    last_date TEXT NOT NULL,
+    unit TEXT NOT NULL,
+    PRIMARY KEY (period, indicator, bucket)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_dates (
+    date TEXT PRIMARY KEY
+) WITHOUT ROWID;
+'''
+
+
+def _merge(row, date, value, unit):
+    """
+    Add a value to an aggregate.
+
+    ``row`` is a list of count, total, minimum, maximum, last value,
+    date of the last value and unit, or ``None`` for an empty aggregate.
+    Returns the updated list.
+    """
+    if row is None:
+        return [1, value, value, value, value, date, unit]
+    row[0] += 1
+    row[1] += value
+    row[2] = min(row[2], value)
+    row[3] = max(row[3], value)
+    if date >= row[5]:
+        row[4:] = [value, date, unit]
+    return row
+
+
+class Rollups(object):
+    """
+    SQLite database of aggregated values.
+
+    Each measurement is only aggregated once, adding a measurement whose
+    date has already been added has no effect. The database can be
+    shared with a ``store.MeasurementStore``.
+    """
+
+    def __init__(self, filename):
+        import sqlite3
+        self.filename = filename
+        self._db = sqlite3.connect(filename, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        """
+        Close the database.
+        """
+        self._db.close()
+
+    def _transaction(self, func, *args):
+        # Transactions are started immediately so that concurrent
+        # updates of the same aggregates are serialized
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            result = func(*args)
+        except:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+        return result
+
+    def _add(self, date, values):
+        cursor = self._db.execute('INSERT OR IGNORE INTO rollup_dates '
+                                  'VALUES (?)', (date,))
+        if not cursor.rowcount:
+            return False
+        for name, value in values.iteritems():
+            name = _text(name)
+            for period, length in PERIODS.iteritems():
+                key = (period, name, date[:length])
+                row = self._db.execute(
+                        'SELECT count, total, min, max, last, last_date, unit '
+                        'FROM rollups WHERE period = ? AND indicator = ? AND '
+                        'bucket = ?', key).fetchone()
+                row = _merge(list(row) if row else None, date,
+                             value['value'], _text(value['unit']))
+                self._db.execute('INSERT OR REPLACE INTO rollups VALUES '
+                                 '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', key + tuple(row))
+        return True
+
+    def add(self, date, values):
+        """
+        Aggregate a measurement.
+
+        ``date`` is the measurement date and ``values`` is a dictionary
+        of values as returned by ``scrape.scrape``. The cost does not
+        depend on the number of aggregated measurements.
+
+        Returns ``False`` if the measurement had already been added.
+        """
+        return self._transaction(self._add, _text(date), values)
+
+    def _replace(self, dates, aggregates):
+        self._db.execute('DELETE FROM rollups')
+        self._db.execute('DELETE FROM rollup_dates')
+        self._db.executemany('INSERT INTO rollup_dates VALUES (?)',
+                             ((date,) for date in dates))
+        self._db.executemany('INSERT INTO rollups VALUES '
+                             '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (key + tuple(row) for key, row in aggregates.iteritems()))
+
+    def rebuild(self, measurements):
+        """
+        Replace all aggregates by those of the given measurements.
+
+        ``measurements`` is an iterable of 2-tuples of date and values
+        (see ``add``), e.g. from ``store.iter_json``. They are
+        aggregated in memory and written in a single transaction.
+
+        Returns the number of aggregated measurements.
+        """
+        dates = set()
+        aggregates = {}
+        for date, values in measurements:
+            date = _text(date)
+            if date in dates:
+                continue
+            dates.add(date)
+            for name, value in values.iteritems():
+                name = _text(name)
+                for period, length in PERIODS.iteritems():
+                    key = (period, name, date[:length])
+                    aggregates[key] = _merge(aggregates.get(key), date,
+                                             value['value'], _text(value['unit']))
+        self._transaction(self._replace, dates, aggregates)
+        return len(dates)
+
+    def query(self, indicator, period='day', start=None, end=None):
+        """
+        Get the aggregated values of an indicator.
+
+        ``period`` is one of ``PERIODS``. ``start`` and ``end`` are
+        measurement dates (or prefixes of them): The buckets from the one
+        which contains ``start`` up to, but not including, the one which
+        contains ``end`` are returned. If they are ``None`` then the
+        range is unbounded.
+
+        Returns a list of 6-tuples of bucket (the common date prefix of
+        the bucket's measurements), count, minimum, maximum, mean and
+        last value in chronological order.
+        """
+        length = PERIODS[period]
+        query = ('SELECT bucket, count, min, max, total / count, last '
+                 'FROM rollups WHERE period = ? AND indicator = ?')
+        params = [period, indicator]
+        if start is not None:
+            query += ' AND bucket >= ?'
+            params.append(start[:length])
+        if end is not None:
+            query += ' AND bucket < ?'
+            params.append(end[:length])
+        query += ' ORDER BY bucket'
+        return self._db.execute(query, params).fetchall()
+
+
+def iter_directory(directory):
+    """
+    Iterate over all measurements in a JSON directory.
+
+    Both individual JSON files and partitions (see ``partitions``) are
+    read. Yields 2-tuples of measurement date and dictionary of values
+    in chronological order.
+    """
+    import heapq
+
+    from partitions import iter_partitions
+    from store import iter_json
+
+    return heapq.merge(iter_json(directory), iter_partitions(directory))
+
+
+if __name__ == '__main__':
+    import argparse
+    import csv
+    import os.path
+    import sys
+
+    parser = argparse.ArgumentParser(
+            description=__doc__.strip().split('\n', 1)[0])
+    parser.add_argument('database', help='SQLite database file')
+    subparsers = parser.add_subparsers(dest='command')
+    rebuild_parser = subparsers.add_parser(
+            'rebuild', help='Aggregate the measurements of a JSON ' +
+                            'directory or measurement database')
+    rebuild_parser.add_argument('source', help='JSON directory or SQLite ' +
+                                'measurement database')
+    query_parser = subparsers.add_parser(
+            'query', help='Print the aggregated values of an indicator as CSV')
+    query_parser.add_argument('indicator', help='Indicator name')
+    query_parser.add_argument('--period', choices=PERIODS, default='day',
+                              help='Aggregation period (default: %(default)s)')
+    query_parser.add_argument('--from', dest='start',
+                              help='First date (inclusive)')
+    query_parser.add_argument('--to', dest='end', help='Last date (exclusive)')
+    args = parser.parse_args()
+
+    rollups = Rollups(args.database)
+    try:
+        if args.command == 'rebuild':
+            from scrape import OutputLock
+            from store import MeasurementStore
+
+            # The scraper must not add measurements meanwhile
+            if os.path.isdir(args.source):
+                with OutputLock(args.source):
+                    count = rollups.rebuild(iter_directory(args.source))
+            else:
+                store = MeasurementStore(args.source)
+                try:
+                    with OutputLock(store=store):
+                        count = rollups.rebuild(store.iter_measurements())
+                finally:
+                    store.close()
+            print 'Aggregated %d measurements.' % count
+        elif args.command == 'query':
+            writer = csv.writer(sys.stdout)
+            writer.writerow([args.period, 'count', 'min', 'max', 'mean', 'last'])
+            writer.writerows(rollups.query(args.indicator, args.period,
+                                           args.start, args.end))
+    finally:
+        rollups.close()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+# Copyright (c) 2015 Code for Karlsruhe (http://codefor.de/karlsruhe)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Adaptive polling schedule.
+
+The Stadtwerke publish new measurements at a roughly regular cadence.
+The scheduler estimates that cadence from the measurement dates seen so
+far and polls frequently around the time at which the next measurement
+is expected and rarely otherwise.
+"""
+
+import collections
+import time
+
+
+# Shortest and longest delay between two polls (in seconds)
+MIN_INTERVAL = 60
+MAX_INTERVAL = 15 * 60
+
+# Half-width of the window around the expected publication time in which
+# we poll at ``MIN_INTERVAL``, as a fraction of the publishing period
+WINDOW = 0.1
+
+# Number of measurement dates used for estimating the publishing period
+HISTORY = 10
+
+
+class PollScheduler(object):
+    """
+    Schedule for polling the date of the latest measurement.
+
+    Call ``observe`` with the result of each poll and ``next_delay`` to
+    find out how long to wait before the next one.
+
+    The publishing period is estimated as the median difference between
+    consecutive measurement dates. The next measurement is expected one
+    period after the current one was first observed (using the local
+    clock, so that the publishing delay is taken into account and the
+    time zone of the measurement dates does not matter). Within a window
+    around that time the poll interval is ``min_interval``. Before the
+    window the scheduler waits until the window starts (but at most
+    ``max_interval``). After the window, or as long as the period is
+    unknown, the interval is doubled after each poll that did not yield
+    a new measurement, up to ``max_interval``. Failed polls (see
+    ``fail``) always double the interval.
+    """
+
+    def __init__(self, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL,
+                 window=WINDOW, history=HISTORY):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.window = window
+        self._dates = collections.deque(maxlen=history)
+        self._seen = None
+        self._delay = min_interval
+        self._failed = False
+
+    def observe(self, date, now=None):
+        """
+        Record the result of a poll.
+
+        ``date`` is the date of the latest measurement and ``now`` is
+        the current time as a UNIX timestamp (defaults to the current
+        time).
+
+        Returns ``True`` if ``date`` is new and ``False`` otherwise.
+        """
+        if now is None:
+            now = time.time()
+        if self._dates and self._dates[-1] == date:
+            self._delay = min(2 * self._delay, self.max_interval)
+            return False
+        self._dates.append(date)
+        self._seen = now
+        self._delay = self.min_interval
+        return True
+
+    def fail(self):
+        """
+        Record a failed poll.
+
+        The delay until the next poll is doubled (up to
+        ``max_interval``).
+        """
+        self._delay = min(2 * self._delay, self.max_interval)
+        self._failed = True
+
+    def period(self):
+        """
+        Estimate the publishing period.
+
+        Returns the period in seconds or ``None`` if less than two
+        different measurement dates have been observed.
+        """
+        dates = sorted(self._dates)
+        diffs = sorted((b - a).total_seconds() for a, b in zip(dates, dates[1:]))
+        if not diffs:
+            return None
+        return diffs[len(diffs) // 2]
+
+    def next_delay(self, now=None):
+        """
+        Get the delay until the next poll.
+
+        ``now`` is the current time as a UNIX timestamp (defaults to the
+        current time).
+
+        Returns the delay in seconds.
+        """
+        if now is None:
+            now = time.time()
+        if self._failed:
+            self._failed = False
+            return self._delay
+        period = self.period()
+        if period is None:
+            return self._delay
+        expected = self._seen + period
+        window = max(self.min_interval, self.window * period)
+        if now < expected - window:
+            self._delay = self.min_interval
+            return max(self.min_interval,
+                       min(expected - window - now, self.max_interval))
+        if now <= expected + window:
+            self._delay = self.min_interval
+            return self.min_interval
+        return self._delay
@@ -28,15 +28,33 @@ This script scrapes the values of several drinking water quality
 indicators from the homepage of the Stadtwerke Karlsruhe.
 """
 
+import binascii
+import collections
 import cStringIO
-import contextlib
 import datetime
-import locale
-import urllib2
+import functools
+import itertools
+import logging
+import os
+import os.path
 
-import PIL.Image
+from bitmap import decode_png, from_image, UnsupportedImage
+from cache import digest
+from fetch import check_status, request
+from glyphs import GlyphTable
+from lock import FileLock, LockTimeout
+from metrics import Metrics
+from partitions import append_measurement, has_measurement, PERIODS
+from sources import DATE_KEY, DATE_SIZE, Source, VALUE_SIZE
+from store import (DATE_FORMAT, json_filename, JSON_LOCK, read_json,
+                   write_json)
 
 
+log = logging.getLogger('codeforka-trinkwasser')
+
+# Durations of the individual stages, download and cache statistics etc.
+metrics = Metrics()
+
 # Homepage:
 # http://www.stadtwerke-karlsruhe.de/swka-de/inhalte/produkte/trinkwasser/online-wert-trinkwasser.php
 
@@ -52,75 +70,283 @@ VALUES = {
     'w6': ('nitrate', 'mg/l'),
 }
 
-def get_image(key, width, height):
+# Maximum number of indicator images that are downloaded in parallel
+CONCURRENCY = len(VALUES)
+
+# Maximum Hamming distance between an unknown character signature and
+# the closest known one for which the character is still recognized.
+MAX_DISTANCE = 2
+
+# Signature of the space character
+SPACE = (0, 0, 0)
+
+# OCR engine used by ``get_text`` unless specified otherwise
+ENGINES = ('segment', 'template')
+ENGINE = 'segment'
+
+# Month abbreviations in the date label (as in the C locale), and the
+# German abbreviations which differ from them
+MONTH_NAMES = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+               'Oct', 'Nov', 'Dec']
+MONTHS = dict((name, index + 1) for index, name in enumerate(MONTH_NAMES))
+MONTHS.update({'Mär': 3, 'Mrz': 3, 'Mai': 5, 'Okt': 10, 'Dez': 12})
+
+# Implementations of the character segmentation. The results of the
+# vectorized ``numpy`` backend are identical to those of the pure-Python
+# one, which works directly on the row and column bitmasks of the images
+# and is at least as fast for images of the size published.
+BACKENDS = ('python', 'numpy')
+BACKEND = 'python'
+
+# Use the ``numpy`` backend if NumPy is available
+USE_NUMPY = BACKEND == 'numpy'
+
+# Binary classification table generated by ``create_classification_table.py``
+CLASSES_FILE = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                            'classes.bin')
+
+# Suffix of the lock file of a store
+STORE_LOCK_SUFFIX = '.lock'
+
+# Maximum time to wait for another process which is storing data in the
+# same output directory or store (in seconds)
+LOCK_TIMEOUT = 10 * 60
+
+# Number of pixels of the border around the text which are cut off at
+# the left, top, right and bottom of an image
+BORDER = (1, 1, 2, 2)
+
+# NumPy is only imported once an image has to be analyzed and PIL only
+# for images which ``bitmap.decode_png`` does not support, so that runs
+# which find no new data start quickly.
+numpy = None
+_numpy_imported = False
+
+
+def get_numpy():
+    """
+    Import NumPy on first use.
+
+    Returns the ``numpy`` module or ``None`` if it is not installed.
+    """
+    global numpy, _numpy_imported
+    if not _numpy_imported:
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        numpy = module
+        _numpy_imported = True
+    return numpy
+
+
+def _use_numpy():
+    return USE_NUMPY and get_numpy() is not None
+
+
+def default_source(output_dir=None, store=None, partition=None,
+                   compress=False, rollups=None):
+    """
+    Get the source for the homepage of the Stadtwerke Karlsruhe.
+
+    Returns a ``sources.Source`` instance for ``IMAGE_URL`` and
+    ``VALUES``. The other arguments are passed on to it.
+    """
+    return Source('karlsruhe', IMAGE_URL, VALUES, output_dir=output_dir,
+                  store=store, partition=partition, compress=compress,
+                  rollups=rollups)
+
+
+def _image_url(key, width, height, source):
+    if source is None:
+        return IMAGE_URL % (height, width, key)
+    return source.image_url(key, width, height)
+
+
+def get_image(key, width, height, source=None):
     """
     Download one of the images/diagrams.
 
     ``key`` is the diagram key (``w1`` to ``w6`` for the indicators,
     ``w9`` for the date image). ``width`` and ``height`` specify the
-    image dimensions.
+    image dimensions. ``source`` is the ``sources.Source`` from which
+    the image is downloaded (defaults to ``IMAGE_URL``).
 
-    The return value is a ``PIL.Image.Image`` instance from which the
-    black border has been cropped.
+    The return value is a ``bitmap.Bitmap`` from which the black border
+    has been cropped.
     """
-    buf = cStringIO.StringIO(urllib2.urlopen(IMAGE_URL % (height, width, key)).read())
-    img = PIL.Image.open(buf)
-    return img.crop((1, 1, img.size[0] - 2, img.size[1] - 2))  # Cut 1 pixel border
+    url = _image_url(key, width, height, source)
+    response = download(url)
+    check_status(url, response)
+    return decode_image(response.body)
+
 
+def download(url, headers=None):
+    """
+    Download a URL and record the download's metrics.
 
-def count_black_pixels(img, left=None, top=None, right=None, bottom=None):
+    ``headers`` is passed on to ``fetch.request``, whose return value
+    is returned. Retries and hedged requests are counted, too.
+    """
+    with metrics.timer('stage_seconds', stage='download'):
+        response = request(url, headers, metrics)
+    metrics.inc('http_responses_total', status=response.status)
+    metrics.inc('downloaded_bytes_total', len(response.body))
+    return response
+
+
+def decode_image(data):
+    """
+    Decode a downloaded image.
+
+    ``data`` is a string containing the image data. PNG images are
+    decoded by ``bitmap.decode_png``, other images (and PNG features
+    which it does not support) by PIL.
+
+    The return value is a ``bitmap.Bitmap`` from which the black border
+    has been cropped.
+    """
+    with metrics.timer('stage_seconds', stage='decode'):
+        try:
+            return decode_png(data, BORDER)
+        except UnsupportedImage:
+            pass
+        import PIL.Image
+        metrics.inc('decode_fallbacks_total')
+        img = PIL.Image.open(cStringIO.StringIO(data))
+        left, top, right, bottom = BORDER
+        return from_image(img.crop((left, top, img.size[0] - right,
+                                    img.size[1] - bottom)))
+
+
+def ocr_version():
+    """
+    Identify the current OCR configuration.
+
+    Returns a string made up of the digest of the classification table,
+    the engine and the maximum distance (``ENGINE`` and
+    ``MAX_DISTANCE``), which changes whenever the texts extracted from
+    the same image may change.
+    """
+    with open(CLASSES.filename, 'rb') as f:
+        table = digest(f.read())
+    return '%s:%s:%d' % (table, ENGINE, MAX_DISTANCE)
+
+
+def get_image_text(key, width, height, cache=None, source=None):
+    """
+    Download one of the images/diagrams and extract its text.
+
+    ``key``, ``width``, ``height`` and ``source`` are as for
+    ``get_image``.
+
+    If ``cache`` is a ``cache.ImageCache`` instance then the image is
+    only downloaded if it has changed since the last download, and its
+    text is only extracted if no image with the same content has been
+    analyzed before.
+    """
+    if cache is None:
+        return get_text(get_image(key, width, height, source))
+    url = _image_url(key, width, height, source)
+    response = download(url, cache.get_validators(url))
+    if response.status == 304:
+        text = cache.get_url_text(url)
+        if text is not None:
+            metrics.inc('cache_lookups_total', result='not_modified')
+            return text
+        response = download(url)  # Cache entry has been evicted meanwhile
+    check_status(url, response)
+    image_digest = digest(response.body)
+    text = cache.get_text(image_digest)
+    if text is None:
+        metrics.inc('cache_lookups_total', result='miss')
+        text = get_text(decode_image(response.body))
+    else:
+        metrics.inc('cache_lookups_total', result='same_content')
+    cache.update(url, response.headers, image_digest, text)
+    return text
+
+
+def count_black_pixels(bitmap, left=None, top=None, right=None, bottom=None):
     """
     Count black pixels in an image row- and column-wise.
 
-    The black pixels in ``img`` are counted row- and column-wise and
-    the result is returned as a 2-tuple.
+    The black pixels in ``bitmap`` (a ``bitmap.Bitmap``) are counted
+    row- and column-wise and the result is returned as a 2-tuple.
 
     ``left``, ``top``, ``right`` and ``bottom`` specify the borders of
     the counting area. If not specified they default to the respective
     image border (e.g. ``top`` defaults to 0). ``left`` and ``top`` are
     inclusive, ``right`` and ``bottom`` are exclusive.
     """
-    columns = img.size[0]
     if left is None:
         left = 0
     if top is None:
         top = 0
     if right is None:
-        right = columns
+        right = bitmap.width
     if bottom is None:
-        bottom = img.size[1]
-    data = img.getdata()
-    hcount = [0] * (bottom - top)
-    vcount = [0] * (right - left)
-    for x in range(left, right):
-        for y in range(top, bottom):
-            if not data[x + y * columns]:
-                hcount[y - top] += 1
-                vcount[x - left] += 1
+        bottom = bitmap.height
+    row_mask = (1 << max(0, right - left)) - 1
+    column_mask = (1 << max(0, bottom - top)) - 1
+    hcount = [popcount(row >> left & row_mask)
+              for row in bitmap.rows[top:bottom]]
+    vcount = [popcount(column >> top & column_mask)
+              for column in bitmap.columns()[left:right]]
     return hcount, vcount
 
 
-def get_block_signature(img, left, top, right, bottom):
+def get_block_signature(bitmap, left, top, right, bottom):
     """
     Get an image block's signature.
 
-    The signature is a list of the running indices of the black pixels
-    in the block.
+    The signature is a 3-tuple containing the block's width and height
+    and an integer bitmask in which the bits corresponding to the
+    running indices of the black pixels in the block are set.
 
     ``left``, ``top``, ``right`` and ``bottom`` specify the borders of
     the block. ``left`` and ``top`` are inclusive, ``right`` and
     ``bottom`` are exclusive.
     """
-    columns = img.size[0]
-    data = img.getdata()
-    sig = []
     width = right - left
-    for y in range(top, bottom):
-        for x in range(left, right):
-            index = x + y * columns
-            if not data[index]:
-                sig.append((x - left) + width * (y - top))
-    return tuple(sig)
+    height = bottom - top
+    mask = (1 << width) - 1
+    bits = 0
+    shift = 0
+    for row in bitmap.rows[top:bottom]:
+        bits |= (row >> left & mask) << shift
+        shift += width
+    return width, height, bits
+
+
+def pack_bits(indices):
+    """
+    Pack bit indices into an integer bitmask.
+    """
+    bits = 0
+    for index in indices:
+        bits |= 1 << index
+    return bits
+
+
+def popcount(bits):
+    """
+    Count the set bits in an integer.
+    """
+    return bin(bits).count('1')
+
+
+def _black_pixels(bitmap):
+    """
+    Return a boolean NumPy array marking the black pixels of a bitmap.
+
+    The array is indexed by row and column.
+    """
+    size = (bitmap.width + 7) // 8
+    data = ''.join(binascii.unhexlify('%0*x' % (2 * size, row))
+                   for row in bitmap.rows)
+    bits = numpy.unpackbits(numpy.frombuffer(data, numpy.uint8))
+    return bits.reshape(bitmap.height, 8 * size)[:, ::-1][:, :bitmap.width] != 0
 
 
 def split(seq):
@@ -154,220 +380,627 @@ def strip(seq):
     return indices[0][0], indices[-1][1]
 
 
-def get_char_signatures(img, space_width=6):
+def get_char_signatures(bitmap, space_width=6):
     """
     Get character signatures for an image.
 
-    The image is assumed to contain one row of characters, each of
-    which is connected. The return value is a list of character
-    signatures for these characters.
+    The image (a ``bitmap.Bitmap``) is assumed to contain one row of
+    characters, each of which is connected. The return value is a list
+    of character signatures for these characters.
 
     If the gap between two characters is equal to or larger than
-    ``space_width`` then a space signature (an empty tuple) is
-    inserted between the characters' signatures.
+    ``space_width`` then a space signature (``SPACE``) is inserted
+    between the characters' signatures.
+    """
+    with metrics.timer('stage_seconds', stage='segment'):
+        if _use_numpy():
+            return _get_char_signatures_numpy(bitmap, space_width)
+        return _get_char_signatures(bitmap, space_width)
+
+
+def _get_char_signatures(bitmap, space_width):
+    """
+    Pure-Python implementation of ``get_char_signatures``.
+
+    The characters are split at blank columns and their vertical extent
+    is taken from the union of their column bitmasks, so no pixels have
+    to be counted.
     """
     signatures = []
-    img = img.convert('L')
-    vcount = count_black_pixels(img)[1]
-    chars = []
+    columns = bitmap.columns()
     last_right = float('Inf')
-    for left, right in split(vcount):
+    for left, right in split(columns):
         if left - last_right >= space_width:
-            signatures.append(())  # Space
-        hcount = count_black_pixels(img, left=left, right=right)[0]
-        top, bottom = strip(hcount)
-        signatures.append(get_block_signature(img, left, top, right, bottom))
+            signatures.append(SPACE)
+        mask = 0
+        for column in columns[left:right]:
+            mask |= column
+        top = _lowest_bit(mask)
+        signatures.append(get_block_signature(bitmap, left, top, right,
+                                              mask.bit_length()))
         last_right = right
     return signatures
 
 
-# This table was generated using ``create_classification_table.py``.
-CLASSES = {
-    (): ' ',
-    (0, 1, 2, 3, 4, 5, 6, 8, 9): '!',
-    (2, 5, 8, 11, 14, 17, 18, 19, 20, 21, 22, 23, 25, 28, 31, 34, 36, 37, 38, 39, 40, 41, 42, 45, 48, 51, 54, 57): '#',
-    (3, 8, 9, 10, 11, 12, 14, 17, 20, 21, 24, 29, 30, 31, 38, 39, 40, 45, 48, 49, 52, 55, 57, 58, 59, 60, 61, 66): '$',
-    (1, 2, 6, 7, 10, 12, 14, 17, 19, 22, 23, 25, 31, 38, 44, 46, 47, 50, 52, 55, 57, 59, 62, 63, 67, 68): '%',
-    (2, 3, 4, 8, 12, 15, 19, 22, 26, 30, 31, 32, 36, 37, 38, 41, 42, 46, 48, 49, 54, 56, 60, 61, 64, 65, 66, 69): '&',
-    (2, 4, 7, 9, 12, 15, 18, 21, 24, 28, 31, 35): '(',
-    (0, 4, 7, 11, 14, 17, 20, 23, 26, 28, 31, 33): ')',
-    (3, 7, 10, 13, 15, 17, 19, 23, 24, 25, 29, 31, 33, 35, 38, 41, 45): '*',
-    (3, 10, 17, 21, 22, 23, 24, 25, 26, 27, 31, 38, 45): '+',
-    (0, 1, 3, 5, 6): ',',
-    (0, 1, 2, 3, 4, 5): '-',
-    (0, 1, 2, 3): '.',
-    (5, 11, 16, 21, 27, 32, 38, 43, 48, 54): '/',
-    (2, 3, 7, 10, 12, 17, 18, 23, 24, 29, 30, 35, 36, 41, 42, 47, 49, 52, 56, 57): '0',
-    (2, 6, 7, 10, 12, 17, 22, 27, 32, 37, 42, 45, 46, 47, 48, 49): '1',
-    (1, 2, 3, 4, 6, 11, 12, 17, 23, 27, 28, 32, 37, 42, 48, 54, 55, 56, 57, 58, 59): '2',
-    (1, 2, 3, 4, 6, 11, 12, 17, 23, 26, 27, 28, 35, 41, 42, 47, 48, 53, 55, 56, 57, 58): '3',
-    (4, 9, 10, 14, 16, 19, 22, 24, 28, 30, 34, 36, 37, 38, 39, 40, 41, 46, 52, 58): '4',
-    (0, 1, 2, 3, 4, 5, 6, 12, 18, 24, 25, 26, 27, 28, 35, 41, 47, 48, 53, 55, 56, 57, 58): '5',
-    (2, 3, 4, 7, 12, 18, 24, 25, 26, 27, 28, 30, 35, 36, 41, 42, 47, 48, 53, 55, 56, 57, 58): '6',
-    (0, 1, 2, 3, 4, 5, 11, 17, 22, 28, 34, 39, 45, 51, 57): '7',
-    (1, 2, 3, 4, 6, 11, 12, 17, 18, 23, 25, 26, 27, 28, 30, 35, 36, 41, 42, 47, 48, 53, 55, 56, 57, 58): '8',
-    (1, 2, 3, 4, 6, 11, 12, 17, 18, 23, 25, 26, 27, 28, 29, 35, 41, 47, 52, 55, 56, 57): '9',
-    (0, 1, 2, 3, 10, 11, 12, 13): ':',
-    (0, 1, 2, 3, 10, 11, 13, 15, 16): ';',
-    (4, 8, 12, 16, 20, 26, 32, 38, 44): '<',
-    (0, 1, 2, 3, 4, 5, 24, 25, 26, 27, 28, 29): '=',
-    (0, 6, 12, 18, 24, 28, 32, 36, 40): '>',
-    (1, 2, 3, 4, 6, 11, 12, 17, 23, 28, 33, 39, 51, 57): '?',
-    (2, 3, 4, 7, 11, 12, 15, 17, 18, 20, 22, 23, 24, 26, 29, 30, 32, 35, 36, 38, 41, 42, 45, 46, 47, 49, 56, 57, 58, 59): '@',
-    (2, 3, 7, 10, 12, 17, 18, 23, 24, 29, 30, 31, 32, 33, 34, 35, 36, 41, 42, 47, 48, 53, 54, 59): 'A',
-    (0, 1, 2, 3, 4, 6, 11, 12, 17, 18, 23, 24, 25, 26, 27, 28, 30, 35, 36, 41, 42, 47, 48, 53, 54, 55, 56, 57, 58): 'B',
-    (1, 2, 3, 4, 6, 11, 12, 18, 24, 30, 36, 42, 48, 53, 55, 56, 57, 58): 'C',
-    (0, 1, 2, 3, 6, 10, 12, 17, 18, 23, 24, 29, 30, 35, 36, 41, 42, 47, 48, 52, 54, 55, 56, 57): 'D',
-    (0, 1, 2, 3, 4, 5, 6, 12, 18, 24, 25, 26, 27, 28, 30, 36, 42, 48, 54, 55, 56, 57, 58, 59): 'E',
-    (0, 1, 2, 3, 4, 5, 6, 12, 18, 24, 25, 26, 27, 28, 30, 36, 42, 48, 54): 'F',
-    (1, 2, 3, 4, 6, 11, 12, 18, 24, 30, 33, 34, 35, 36, 41, 42, 47, 48, 52, 53, 55, 56, 57, 59): 'G',
-    (0, 5, 6, 11, 12, 17, 18, 23, 24, 25, 26, 27, 28, 29, 30, 35, 36, 41, 42, 47, 48, 53, 54, 59): 'H',
-    (0, 1, 2, 3, 4, 7, 12, 17, 22, 27, 32, 37, 42, 45, 46, 47, 48, 49): 'I',
-    (3, 4, 5, 10, 16, 22, 28, 34, 40, 42, 46, 48, 52, 55, 56, 57): 'J',
-    (0, 5, 6, 10, 12, 15, 18, 20, 24, 25, 30, 31, 36, 38, 42, 45, 48, 52, 54, 59): 'K',
-    (0, 6, 12, 18, 24, 30, 36, 42, 48, 54, 55, 56, 57, 58, 59): 'L',
-    (0, 6, 7, 8, 12, 13, 14, 15, 19, 20, 21, 23, 25, 27, 28, 30, 32, 34, 35, 38, 41, 42, 45, 48, 49, 55, 56, 62, 63, 69): 'M',
-    (0, 5, 6, 7, 11, 12, 13, 17, 18, 20, 23, 24, 26, 29, 30, 33, 35, 36, 39, 41, 42, 46, 47, 48, 52, 53, 54, 59): 'N',
-    (1, 2, 3, 4, 6, 11, 12, 17, 18, 23, 24, 29, 30, 35, 36, 41, 42, 47, 48, 53, 55, 56, 57, 58): 'O',
-    (0, 1, 2, 3, 4, 6, 11, 12, 17, 18, 23, 24, 25, 26, 27, 28, 30, 36, 42, 48, 54): 'P',
-    (1, 2, 3, 4, 7, 12, 14, 19, 21, 26, 28, 33, 35, 40, 42, 47, 49, 51, 52, 54, 56, 57, 60, 61, 64, 65, 66, 67, 75, 76): 'Q',
-    (0, 1, 2, 3, 4, 6, 11, 12, 17, 18, 23, 24, 25, 26, 27, 28, 30, 33, 36, 40, 42, 46, 48, 53, 54, 59): 'R',
-    (1, 2, 3, 4, 6, 11, 12, 17, 18, 25, 26, 33, 34, 41, 42, 47, 48, 53, 55, 56, 57, 58): 'S',
-    (0, 1, 2, 3, 4, 5, 6, 10, 17, 24, 31, 38, 45, 52, 59, 66): 'T',
-    (0, 5, 6, 11, 12, 17, 18, 23, 24, 29, 30, 35, 36, 41, 42, 47, 48, 53, 55, 56, 57, 58): 'U',
-    (0, 6, 7, 13, 14, 20, 22, 26, 29, 33, 36, 40, 44, 46, 51, 53, 59, 66): 'V',
-    (0, 6, 7, 13, 14, 20, 21, 24, 27, 28, 31, 34, 35, 38, 41, 42, 45, 48, 49, 51, 53, 55, 56, 58, 60, 62, 64, 68): 'W',
-    (0, 5, 6, 11, 13, 16, 19, 22, 26, 27, 32, 33, 37, 40, 43, 46, 48, 53, 54, 59): 'X',
-    (0, 6, 7, 13, 15, 19, 22, 26, 30, 32, 38, 45, 52, 59, 66): 'Y',
-    (0, 1, 2, 3, 4, 5, 11, 17, 22, 27, 32, 37, 42, 48, 54, 55, 56, 57, 58, 59): 'Z',
-    (0, 1, 2, 3, 6, 9, 12, 15, 18, 21, 24, 27, 30, 33, 34, 35): '[',
-    (0, 6, 13, 20, 26, 33, 39, 46, 53, 59): '\\',
-    (0, 1, 2, 5, 8, 11, 14, 17, 20, 23, 26, 29, 32, 33, 34, 35): ']',
-    (2, 3, 7, 10, 12, 17): '^',
-    (0, 1, 2, 3, 4, 5, 6): '_',
-    (0, 1, 2, 4, 7): '`',
-    (1, 2, 3, 4, 6, 11, 15, 16, 17, 19, 20, 23, 24, 29, 30, 34, 35, 37, 38, 39, 41): 'a',
-    (0, 6, 12, 18, 20, 21, 22, 24, 25, 29, 30, 35, 36, 41, 42, 47, 48, 49, 53, 54, 56, 57, 58): 'b',
-    (1, 2, 3, 4, 6, 11, 12, 18, 24, 30, 35, 37, 38, 39, 40): 'c',
-    (5, 11, 17, 19, 20, 21, 23, 24, 28, 29, 30, 35, 36, 41, 42, 47, 48, 52, 53, 55, 56, 57, 59): 'd',
-    (1, 2, 3, 4, 6, 11, 12, 17, 18, 19, 20, 21, 22, 23, 24, 30, 37, 38, 39, 40): 'e',
-    (2, 3, 4, 7, 11, 13, 19, 24, 25, 26, 27, 28, 31, 37, 43, 49, 55): 'f',
-    (5, 7, 8, 9, 11, 12, 16, 18, 22, 24, 28, 31, 32, 33, 37, 43, 44, 45, 46, 48, 53, 54, 59, 61, 62, 63, 64): 'g',
-    (0, 6, 12, 18, 20, 21, 22, 24, 25, 29, 30, 35, 36, 41, 42, 47, 48, 53, 54, 59): 'h',
-    (2, 7, 16, 17, 22, 27, 32, 37, 42, 45, 46, 47, 48, 49): 'i',
-    (4, 9, 18, 19, 24, 29, 34, 39, 44, 49, 54, 55, 58, 61, 62): 'j',
-    (0, 6, 12, 18, 22, 24, 27, 30, 32, 36, 37, 38, 42, 45, 48, 52, 54, 59): 'k',
-    (1, 2, 7, 12, 17, 22, 27, 32, 37, 42, 45, 46, 47, 48, 49): 'l',
-    (0, 1, 2, 4, 5, 7, 10, 13, 14, 17, 20, 21, 24, 27, 28, 31, 34, 35, 38, 41, 42, 45, 48): 'm',
-    (0, 2, 3, 4, 6, 7, 11, 12, 17, 18, 23, 24, 29, 30, 35, 36, 41): 'n',
-    (1, 2, 3, 4, 6, 11, 12, 17, 18, 23, 24, 29, 30, 35, 37, 38, 39, 40): 'o',
-    (0, 2, 3, 4, 6, 7, 11, 12, 17, 18, 23, 24, 29, 30, 31, 35, 36, 38, 39, 40, 42, 48, 54): 'p',
-    (1, 2, 3, 5, 6, 10, 11, 12, 17, 18, 23, 24, 29, 30, 34, 35, 37, 38, 39, 41, 47, 53, 59): 'q',
-    (0, 2, 3, 4, 6, 7, 11, 12, 18, 24, 30, 36): 'r',
-    (1, 2, 3, 4, 6, 11, 12, 19, 20, 21, 22, 29, 30, 35, 37, 38, 39, 40): 's',
-    (2, 8, 12, 13, 14, 15, 16, 20, 26, 32, 38, 44, 50, 53, 57, 58): 't',
-    (0, 5, 6, 11, 12, 17, 18, 23, 24, 29, 30, 34, 35, 37, 38, 39, 41): 'u',
-    (0, 5, 6, 11, 12, 17, 19, 22, 25, 28, 32, 33, 38, 39): 'v',
-    (0, 6, 7, 10, 13, 14, 17, 20, 21, 24, 27, 28, 31, 34, 35, 37, 39, 41, 43, 47): 'w',
-    (0, 5, 6, 11, 13, 16, 20, 21, 25, 28, 30, 35, 36, 41): 'x',
-    (0, 5, 6, 11, 12, 17, 18, 23, 24, 29, 31, 34, 35, 38, 39, 41, 47, 52, 55, 56, 57): 'y',
-    (0, 1, 2, 3, 4, 5, 10, 15, 20, 25, 30, 36, 37, 38, 39, 40, 41): 'z',
-    (1, 2, 3, 6, 10, 13, 15, 18, 22, 25, 27, 30, 34, 35): '{',
-    (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13): '|',
-    (0, 1, 5, 8, 10, 13, 17, 20, 22, 25, 29, 32, 33, 34): '}',
-    (1, 2, 6, 7, 10, 13, 14, 18, 19): '~',
-}
+def _get_char_signatures_numpy(bitmap, space_width):
+    """
+    Vectorized implementation of ``get_char_signatures``.
+
+    The bitmap is converted into an array once and the character
+    blocks are cut from it by slicing.
+    """
+    black = _black_pixels(bitmap)
+    signatures = []
+    last_right = float('Inf')
+    for left, right in split(black.sum(axis=0).tolist()):
+        if left - last_right >= space_width:
+            signatures.append(SPACE)
+        block = black[:, left:right]
+        top, bottom = strip(block.sum(axis=1).tolist())
+        bits = pack_bits(numpy.flatnonzero(block[top:bottom]).tolist())
+        signatures.append((right - left, bottom - top, bits))
+        last_right = right
+    return signatures
+
+
+# Maps character signatures to characters
+CLASSES = GlyphTable(CLASSES_FILE)
 
 
-def get_text(img):
+def classify(sig, max_distance=None):
     """
-    Extract text from image.
+    Classify a character signature.
+
+    Returns the character whose signature matches ``sig`` exactly. If
+    there is no such character then the character with the closest
+    signature of the same dimensions is returned, provided that the
+    Hamming distance between the signatures is at most
+    ``max_distance`` (which defaults to ``MAX_DISTANCE``). Otherwise a
+    ``KeyError`` is raised.
     """
-    signatures = get_char_signatures(img)
-    chars = [CLASSES[sig] for sig in signatures]
+    try:
+        return CLASSES[sig]
+    except KeyError:
+        pass
+    if max_distance is None:
+        max_distance = MAX_DISTANCE
+    width, height, bits = sig
+    best_distance = max_distance + 1
+    best_char = None
+    for other, char in CLASSES.neighbours(width, height):
+        distance = popcount(bits ^ other)
+        if distance < best_distance:
+            best_distance = distance
+            best_char = char
+    if best_char is None:
+        raise KeyError(sig)
+    return best_char
+
+
+def _lowest_bit(bits):
+    return (bits & -bits).bit_length() - 1
+
+
+def _get_block_signature(columns):
+    """
+    Get the signature of a block from its column bitmasks.
+
+    The result is the same as that of ``get_block_signature`` for the
+    block's bounding box.
+    """
+    width = len(columns)
+    mask = 0
+    for column in columns:
+        mask |= column
+    top = _lowest_bit(mask)
+    bits = 0
+    for x, column in enumerate(columns):
+        column >>= top
+        index = x
+        while column:
+            if column & 1:
+                bits |= 1 << index
+            column >>= 1
+            index += width
+    return width, mask.bit_length() - top, bits
+
+
+_templates = None
+
+
+def _get_templates():
+    """
+    Get the character templates for ``match_templates``.
+
+    Returns a dictionary which maps the first column of a template
+    (shifted so that its lowest bit is bit 0) to a list of 4-tuples
+    containing the template's column bitmasks, the shift of its first
+    column, its vertical offset within the character cell and its
+    character. Wider templates come first, and segmentable characters
+    come before others of the same width.
+    """
+    global _templates
+    if _templates is None:
+        templates = {}
+        for glyph in CLASSES.glyphs():
+            width, height, bits = glyph.signature
+            if not width:
+                continue
+            columns = []
+            for x in range(width):
+                column = 0
+                for y in range(height):
+                    if bits >> (x + y * width) & 1:
+                        column |= 1 << y
+                columns.append(column)
+            shift = _lowest_bit(columns[0])
+            templates.setdefault(columns[0] >> shift, []).append(
+                    (-width, not glyph.segmentable, tuple(columns), shift,
+                     glyph.top, glyph.char))
+        for key, candidates in templates.iteritems():
+            templates[key] = [c[2:] for c in sorted(candidates)]
+        _templates = templates
+    return _templates
+
+
+def _match_at(columns, x, row_top, templates):
+    """
+    Find the templates which match the columns starting at index ``x``.
+
+    If ``row_top`` is not ``None`` then only templates whose character
+    cell starts at that row are considered.
+
+    Returns a list of 3-tuples of width, top row of the character cell
+    and character.
+    """
+    mask = columns[x]
+    low = _lowest_bit(mask)
+    matches = []
+    for template, shift, top, char in templates.get(mask >> low, ()):
+        offset = low - shift
+        if offset < 0 or (row_top is not None and offset - top != row_top):
+            continue
+        width = len(template)
+        if x + width > len(columns):
+            continue
+        for i in xrange(1, width):
+            if columns[x + i] != template[i] << offset:
+                break
+        else:
+            matches.append((width, offset - top, char))
+    return matches
+
+
+def match_templates(bitmap, space_width=6, max_distance=None):
+    """
+    Extract text from an image by matching character templates.
+
+    The image (a ``bitmap.Bitmap``) is assumed to contain one row of
+    characters. Unlike ``get_char_signatures`` this does not require the
+    characters to be connected or separated by blank columns: The
+    columns of the image are scanned once from left to right and at each
+    non-blank column the templates of all known characters are matched,
+    preferring wider ones. Characters of the same shape (``'`` and
+    ``,``) are told apart by their vertical position within the
+    character cells of the row, which is determined by the other
+    characters.
+
+    Where no template matches, the block of columns up to the next blank
+    column is classified using ``classify``, so that the results are the
+    same as with ``get_char_signatures`` for text which it can handle.
+    ``max_distance`` is passed on to ``classify``.
+
+    If the gap between two characters is equal to or larger than
+    ``space_width`` then a space is inserted between them.
+    """
+    templates = _get_templates()
+    columns = bitmap.columns()
+    count = len(columns)
+    row_top = None
+    chars = []  # Characters or, if ambiguous, lists of (top, char)
+    last_right = float('Inf')
+    x = 0
+    while x < count:
+        if not columns[x]:
+            x += 1
+            continue
+        if x - last_right >= space_width:
+            chars.append(' ')
+        matches = [(width, top, char) for width, top, char
+                   in _match_at(columns, x, row_top, templates)
+                   if x + width == count or not columns[x + width] or
+                   _match_at(columns, x + width, row_top, templates)]
+        if matches:
+            width = matches[0][0]
+            options = []
+            for other_width, top, char in matches:
+                if other_width == width and char not in [c for _, c in options]:
+                    options.append((top, char))
+            if len(options) == 1:
+                chars.append(options[0][1])
+                if row_top is None:
+                    row_top = options[0][0]
+            else:
+                chars.append(options)
+            right = x + width
+        else:
+            right = x + 1
+            while right < count and columns[right]:
+                right += 1
+            chars.append(classify(_get_block_signature(columns[x:right]),
+                                  max_distance))
+        last_right = x = right
+    text = []
+    for char in chars:
+        if isinstance(char, list):
+            char = dict(char).get(row_top, char[0][1])
+        text.append(char)
+    return ''.join(text)
+
+
+def get_text(bitmap, max_distance=None, engine=None):
+    """
+    Extract text from an image (a ``bitmap.Bitmap``).
+
+    ``engine`` is the OCR engine (defaults to ``ENGINE``): ``segment``
+    splits the image into characters (see ``get_char_signatures``) and
+    classifies them, ``template`` uses ``match_templates``. Both give
+    the same results for text which the ``segment`` engine can handle.
+    ``max_distance`` is passed on to ``classify``.
+    """
+    if engine is None:
+        engine = ENGINE
+    if engine == 'template':
+        with metrics.timer('stage_seconds', stage='match'):
+            text = match_templates(bitmap, max_distance=max_distance)
+        metrics.inc('glyphs_total', len(text))
+        return text
+    if engine != 'segment':
+        raise ValueError('Unknown OCR engine "%s"' % engine)
+    signatures = get_char_signatures(bitmap)
+    with metrics.timer('stage_seconds', stage='classify'):
+        chars = [classify(sig, max_distance) for sig in signatures]
+    metrics.inc('glyphs_total', len(chars))
     return ''.join(chars)
 
 
-def get_value(key):
+def get_value(key, cache=None, source=None):
     """
     Get diagram value.
 
-    ``key`` is the diagram key (``w1`` to ``w6``).
+    ``key`` is the diagram key (``w1`` to ``w6``). ``cache`` and
+    ``source`` are passed on to ``get_image_text``.
 
     The diagram is downloaded, its text is extracted, converted to
     float and returned.
     """
-    img = get_image(key, 70, 50)
-    return float(get_text(img))
+    width, height = source.value_size if source else VALUE_SIZE
+    return float(get_image_text(key, width, height, cache, source))
 
 
-@contextlib.contextmanager
-def local_locale(name):
+def parse_date(label):
     """
-    Context-manager to temporarily switch to a different locale.
+    Parse the text of the date image.
+
+    The month is looked up in ``MONTHS`` instead of parsing the label
+    with ``strptime``, which depends on the process-wide locale and is
+    not thread-safe in Python 2.
+
+    Returns a ``datetime.datetime`` instance. Raises ``ValueError`` if
+    the label cannot be parsed.
     """
-    old = locale.getlocale(locale.LC_ALL)
     try:
-        yield locale.setlocale(locale.LC_ALL, name)
-    finally:
-        locale.setlocale(locale.LC_ALL, old)
+        day, month, year, clock = label.split(':', 1)[1].split()
+        hour, minute = clock.split(':')
+        month = MONTHS[month]
+    except (KeyError, IndexError, ValueError):
+        raise ValueError('Invalid date label "%s"' % label)
+    year = int(year)
+    # Two-digit years are interpreted like "%y" does
+    year += 2000 if year < 69 else 1900
+    return datetime.datetime(year, month, int(day), int(hour), int(minute))
 
 
-def get_date():
+def get_date(cache=None, source=None):
     """
     Get time and date of the last update.
 
     The date image is downloaded, its text is extracted, converted to
-    a ``datetime.datetime`` instance and returned.
+    a ``datetime.datetime`` instance (see ``parse_date``) and returned.
+    ``cache`` and ``source`` are passed on to ``get_image_text``.
     """
-    img = get_image('w9', 300, 20)
-    label = get_text(img)
-    with local_locale('C'):
-        date = datetime.datetime.strptime(label.split(':', 1)[1].strip(), '%d %b %y %H:%M')
-    return date
+    if source:
+        key, (width, height) = source.date_key, source.date_size
+    else:
+        key, (width, height) = DATE_KEY, DATE_SIZE
+    return parse_date(get_image_text(key, width, height, cache, source))
 
 
-def scrape():
+def scrape(concurrency=CONCURRENCY, cache=None, source=None):
     """
     Download and parse data.
 
+    The indicator images are downloaded and parsed in parallel by up
+    to ``concurrency`` threads. ``cache`` and ``source`` are passed on
+    to ``get_image_text``.
+
     Returns a dictionary with the latest values.
     """
+    import multiprocessing.pool
+    indicators = source.values if source else VALUES
+    keys = sorted(indicators)
+    pool = multiprocessing.pool.ThreadPool(max(1, min(concurrency, len(keys))))
+    try:
+        results = pool.map(functools.partial(get_value, cache=cache,
+                                             source=source), keys)
+    finally:
+        pool.close()
+    return _make_values(indicators, zip(keys, results))
+
+
+def _make_values(indicators, results):
+    """
+    Build the dictionary of values returned by ``scrape``.
+
+    ``indicators`` maps image keys to indicator names and units and
+    ``results`` is an iterable of 2-tuples of image key and value.
+    """
     values = {}
-    for key, (name, unit) in VALUES.iteritems():
+    for key, value in results:
+        name, unit = indicators[key]
         values[name] = {
             'unit': unit,
-            'value': get_value(key),
+            'value': value,
         }
     return values
 
 
-def symlink(target, filename):
+def _missing_outputs(stamp, output_dir, store, partition=None):
     """
-    Create a symlink.
+    Check whether a measurement still has to be stored.
+
+    ``partition`` is the partition period of ``output_dir`` or ``None``
+    if it contains individual JSON files (see ``partitions``).
 
-    An existing file of the same name is overwritten.
+    Returns a 2-tuple of booleans which are true if the measurement has
+    to be written to ``output_dir`` and ``store``, respectively.
     """
-    try:
-        os.remove(filename)
-    except OSError as e:
-        if e.errno != errno.ENOENT:
+    if not output_dir:
+        write_file = False
+    elif partition:
+        write_file = not has_measurement(output_dir, stamp, partition)
+    else:
+        filename = json_filename(output_dir, stamp)
+        write_file = not os.path.isfile(filename)
+        if not write_file:
+            try:
+                read_json(filename)
+            except (ValueError, KeyError):
+                log.warning('Replacing invalid file "%s"', filename)
+                write_file = True
+    write_store = bool(store) and not store.has(stamp)
+    return write_file, write_store
+
+
+def _write_outputs(stamp, values, output_dir, store, write_file, write_store,
+                   partition=None, compress=False, rollups=None):
+    """
+    Store a measurement where it is missing (see ``_missing_outputs``).
+
+    If the measurement has been scraped then it is also added to
+    ``rollups``.
+    """
+    if write_file or write_store:
+        with metrics.timer('stage_seconds', stage='output'):
+            if write_file and partition:
+                append_measurement(output_dir, stamp, values, partition,
+                                   compress)
+            elif write_file:
+                write_json(output_dir, stamp, values)
+            if write_store:
+                store.add(stamp, values)
+            if rollups and values is not None:
+                rollups.add(stamp, values)
+    if output_dir:
+        metrics.inc('outputs_total', output='json',
+                    action='written' if write_file else 'skipped')
+    if store:
+        metrics.inc('outputs_total', output='store',
+                    action='written' if write_store else 'skipped')
+
+
+class OutputLock(object):
+    """
+    Lock for an output directory and/or a store.
+
+    Only one process at a time should store data in an output directory
+    or store. If one of the locks is held elsewhere then ``acquire``
+    blocks for up to ``timeout`` seconds (defaults to ``LOCK_TIMEOUT``)
+    and raises ``lock.LockTimeout`` if that is not enough. Instances can
+    be used as context managers.
+    """
+
+    def __init__(self, output_dir=None, store=None, timeout=None):
+        self.timeout = LOCK_TIMEOUT if timeout is None else timeout
+        self._locks = []
+        if output_dir:
+            self._locks.append(FileLock(os.path.join(output_dir, JSON_LOCK)))
+        if store:
+            self._locks.append(FileLock(store.filename + STORE_LOCK_SUFFIX))
+        self._held = []
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def acquire(self):
+        try:
+            for lock in self._locks:
+                try:
+                    lock.acquire(0)
+                except LockTimeout:
+                    log.info('Waiting for lock "%s"', lock.filename)
+                    metrics.inc('lock_waits_total')
+                    lock.acquire(self.timeout)
+                self._held.append(lock)
+        except:
+            self.release()
             raise
-    os.symlink(target, filename)
+
+    def release(self):
+        while self._held:
+            self._held.pop().release()
+
+
+def update_sources(sources, concurrency=CONCURRENCY, cache=None,
+                   publisher=None):
+    """
+    Scrape the latest data of several sources.
+
+    ``sources`` is a list of ``sources.Source`` instances. The data of
+    each source is stored in its output directory and/or store unless
+    it is already stored there, and new data is aggregated in its
+    rollup database.
+
+    The outputs of each source with new data are locked while the data
+    is scraped and stored (see ``OutputLock``). If another process is
+    already scraping the same measurement then this waits for it instead
+    of scraping it again.
+
+    All images are downloaded and analyzed by a single pool of
+    ``concurrency`` threads: First the dates of all sources are
+    fetched, then the indicator images of all sources with new data.
+    The latter are interleaved by host, so that a host whose connection
+    limit has been reached (see ``fetch.set_host_limits``) does not hold
+    up the others. ``cache`` is passed on to ``get_image_text``. If
+    ``publisher`` is a ``publish.Publisher`` instance then newly stored
+    data is pushed to its subscribers.
+
+    Returns a dictionary which maps source names to the dates of their
+    latest measurements (as ``datetime.datetime`` instances) or to
+    ``None`` if a source could not be updated. Errors are logged.
+    """
+    import multiprocessing.pool
+
+    def attempt(source, func, *args):
+        try:
+            return func(*args)
+        except Exception:
+            log.exception('Error while scraping "%s"', source.name)
+            return None
+
+    def get_source_date(source):
+        return attempt(source, get_date, cache, source)
+
+    def get_source_value(task):
+        source, key = task
+        return attempt(source, get_value, key, cache, source)
+
+    before = metrics.snapshot()
+    dates = dict((source.name, None) for source in sources)
+    pool = multiprocessing.pool.ThreadPool(max(1, concurrency))
+    locks = []
+    try:
+        with metrics.timer('stage_seconds', stage='update'):
+            with metrics.timer('stage_seconds', stage='date'):
+                results = pool.map(get_source_date, sources)
+            pending = []
+            for source, date in zip(sources, results):
+                if date is None:
+                    continue
+                stamp = date.strftime(DATE_FORMAT)
+                log.info('Date of last measurement of "%s": %s', source.name, stamp)
+                missing = _missing_outputs(stamp, source.output_dir, source.store,
+                                           source.partition)
+                if any(missing):
+                    pending.append((source, date, missing))
+                else:
+                    log.info('Data of "%s" already scraped', source.name)
+                    _write_outputs(stamp, None, source.output_dir, source.store,
+                                   *missing)
+                    dates[source.name] = date
+            # Lock the outputs of the sources with new data, then check
+            # again whether another process has stored it meanwhile
+            candidates, pending = pending, []
+            for source, date, missing in candidates:
+                lock = OutputLock(source.output_dir, source.store)
+                try:
+                    lock.acquire()
+                except LockTimeout as e:
+                    log.error('Cannot store data of "%s": %s', source.name, e)
+                    continue
+                locks.append(lock)
+                stamp = date.strftime(DATE_FORMAT)
+                missing = _missing_outputs(stamp, source.output_dir,
+                                           source.store, source.partition)
+                if any(missing):
+                    pending.append((source, date, missing))
+                else:
+                    log.info('Data of "%s" has been scraped by another process',
+                             source.name)
+                    _write_outputs(stamp, None, source.output_dir, source.store,
+                                   *missing)
+                    dates[source.name] = date
+            if pending:
+                log.info('Scraping data of %d source(s)', len(pending))
+                by_host = collections.OrderedDict()
+                for source, date, missing in pending:
+                    by_host.setdefault(source.host, []).extend(
+                            (source, key) for key in sorted(source.values))
+                tasks = [task for tasks in itertools.izip_longest(*by_host.values())
+                         for task in tasks if task is not None]
+                with metrics.timer('stage_seconds', stage='scrape'):
+                    results = dict(zip(((source.name, key) for source, key in tasks),
+                                       pool.map(get_source_value, tasks)))
+                for source, date, missing in pending:
+                    values = [(key, results[source.name, key]) for key in source.values]
+                    if any(value is None for key, value in values):
+                        continue
+                    stamp = date.strftime(DATE_FORMAT)
+                    values = _make_values(source.values, values)
+                    try:
+                        _write_outputs(stamp, values, source.output_dir,
+                                       source.store, *missing,
+                                       partition=source.partition,
+                                       compress=source.compress,
+                                       rollups=source.rollups)
+                    except Exception:
+                        log.exception('Error while storing data of "%s"', source.name)
+                        continue
+                    if publisher:
+                        publisher.publish(stamp, values, source.name)
+                    dates[source.name] = date
+            if cache:
+                cache.save()
+    finally:
+        pool.close()
+        for lock in locks:
+            lock.release()
+    log.info('Metrics: %s', metrics.format(before))
+    return dates
 
 
 if __name__ == '__main__':
-    import codecs
-    import errno
-    import json
-    import logging
+    import argparse
     import logging.handlers
-    import os
-    import os.path
     import sys
+    import threading
+    import time
+
+    import fetch
+    from cache import ImageCache
+    from fetch import set_host_limits
+    from publish import EventStream, Publisher, Webhook
+    from rollups import Rollups
+    from schedule import MAX_INTERVAL, MIN_INTERVAL, PollScheduler
+    from serve import make_server
+    from sources import load_config
+    from store import MeasurementStore
 
     HERE = os.path.abspath(os.path.dirname(__file__))
-    log = logging.getLogger('codeforka-trinkwasser')
     log.setLevel(logging.INFO)
     formatter = logging.Formatter('[%(asctime)s] <%(levelname)s> %(message)s')
     file_handler = logging.handlers.TimedRotatingFileHandler(
@@ -378,31 +1011,204 @@ if __name__ == '__main__':
 
     log.info('Started')
 
-    if len(sys.argv) != 2:
-        log.error('Illegal number of arguments: Expected 1, got %d' %
-                  (len(sys.argv) - 1))
-        sys.exit(1)
-    OUTPUT_DIR = os.path.abspath(sys.argv[1])
-    if not os.path.isdir(OUTPUT_DIR):
-        log.error('Output directory "%s" does not exist' % OUTPUT_DIR)
-        sys.exit(1)
-    log.info('Output directory is "%s"' % OUTPUT_DIR)
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('output_dir', nargs='?',
+                        help='Output directory for JSON files')
+    parser.add_argument('--config', metavar='FILE',
+                        help='Configuration file with the sources to ' +
+                             'scrape (see sources.py)')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY,
+                        help='Maximum number of parallel downloads ' +
+                             '(default: %(default)s)')
+    parser.add_argument('--max-distance', type=int, default=MAX_DISTANCE,
+                        help='Maximum number of differing pixels for ' +
+                             'approximate character matches ' +
+                             '(default: %(default)s)')
+    parser.add_argument('--engine', choices=ENGINES, default=ENGINE,
+                        help='OCR engine (default: %(default)s)')
+    parser.add_argument('--backend', choices=BACKENDS, default=BACKEND,
+                        help='Implementation of the character segmentation ' +
+                             'of the segment engine, numpy requires NumPy ' +
+                             '(default: %(default)s)')
+    parser.add_argument('--timeout', type=float, default=fetch.READ_TIMEOUT,
+                        help='Timeout for connecting and for each read ' +
+                             '(in seconds, default: %(default)s)')
+    parser.add_argument('--retries', type=int, default=fetch.RETRIES,
+                        help='Maximum number of retries of a failed ' +
+                             'download (default: %(default)s)')
+    parser.add_argument('--deadline', type=float, default=fetch.DEADLINE,
+                        help='Maximum duration of a download including ' +
+                             'retries (in seconds, default: %(default)s)')
+    parser.add_argument('--hedge', action='store_true',
+                        help='Send a second request for downloads that ' +
+                             'take longer than usual')
+    parser.add_argument('--cache', metavar='FILE',
+                        help='Cache file for conditional downloads and ' +
+                             'extracted texts')
+    parser.add_argument('--partition', choices=PERIODS,
+                        help='Append the data to one newline-delimited ' +
+                             'JSON file per day or month instead of ' +
+                             'writing one JSON file per measurement')
+    parser.add_argument('--compress', action='store_true',
+                        help='Compress partitions once they are complete')
+    parser.add_argument('--store', metavar='FILE',
+                        help='SQLite database in which the data is stored')
+    parser.add_argument('--rollups', metavar='FILE',
+                        help='SQLite database in which hourly, daily and ' +
+                             'monthly aggregates are maintained')
+    parser.add_argument('--webhook', metavar='URL', action='append',
+                        default=[],
+                        help='Send new data to this URL via HTTP POST ' +
+                             '(can be given several times)')
+    parser.add_argument('--sse-port', type=int,
+                        help='Stream new data as Server-Sent Events on ' +
+                             'this port')
+    parser.add_argument('--sse-host', default='localhost',
+                        help='Host on which the event stream listens ' +
+                             '(default: %(default)s)')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='File to which metrics are written in the ' +
+                             'Prometheus text format after each run')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running and poll for new measurements')
+    parser.add_argument('--min-interval', type=float, default=MIN_INTERVAL,
+                        help='Minimum delay between polls in daemon mode ' +
+                             '(in seconds, default: %(default)s)')
+    parser.add_argument('--max-interval', type=float, default=MAX_INTERVAL,
+                        help='Maximum delay between polls in daemon mode ' +
+                             '(in seconds, default: %(default)s)')
+    args = parser.parse_args()
+    MAX_DISTANCE = args.max_distance
+    ENGINE = args.engine
+    USE_NUMPY = args.backend == 'numpy'
+    if USE_NUMPY and get_numpy() is None:
+        parser.error('The numpy backend requires NumPy')
+    fetch.CONNECT_TIMEOUT = min(fetch.CONNECT_TIMEOUT, args.timeout)
+    fetch.READ_TIMEOUT = args.timeout
+    fetch.RETRIES = args.retries
+    fetch.DEADLINE = args.deadline
+    fetch.HEDGE = args.hedge
 
-    try:
-        date = get_date().strftime('%Y-%m-%d-%H-%M-00')
-        log.info('Date of last measurement: %s', date)
-        basename = 'karlsruhe-drinking-water-' + date + '.json'
-        filename = os.path.join(OUTPUT_DIR, basename)
-        if not os.path.isfile(filename):
-            log.info('Scraping data')
-            values = scrape()
-            with codecs.open(filename, 'w', encoding='utf8') as f:
-                json.dump({'date': date, 'values': values}, f,
-                          separators=(',',':'))
-            symlink(basename, os.path.join(OUTPUT_DIR, 'latest.json'))
-        else:
-            log.info('Data already scraped, nothing to do')
-    except Exception as e:
-        log.exception(e)
+    if args.config:
+        if (args.output_dir or args.store or args.partition or args.compress or
+                args.rollups):
+            log.error('Output options cannot be combined with a ' +
+                      'configuration file')
+            sys.exit(1)
+        try:
+            SOURCES, hosts = load_config(args.config)
+        except (IOError, ValueError) as e:
+            log.error('Could not load configuration file "%s": %s' % (
+                      args.config, e))
+            sys.exit(1)
+        log.info('Configuration file is "%s"' % args.config)
+        for host, limits in hosts.iteritems():
+            set_host_limits(host, **limits)
+    else:
+        if not (args.output_dir or args.store):
+            log.error('Neither output directory nor store given')
+            sys.exit(1)
+        OUTPUT_DIR = None
+        if args.output_dir:
+            OUTPUT_DIR = os.path.abspath(args.output_dir)
+        store = None
+        if args.store:
+            store = MeasurementStore(args.store)
+        rollups = None
+        if args.rollups:
+            rollups = Rollups(args.rollups)
+        SOURCES = [default_source(OUTPUT_DIR, store, args.partition,
+                                  args.compress, rollups)]
+
+    for source in SOURCES:
+        if source.output_dir:
+            if not os.path.isdir(source.output_dir):
+                log.error('Output directory "%s" does not exist' % source.output_dir)
+                sys.exit(1)
+            log.info('Output directory of "%s" is "%s"' % (source.name,
+                     source.output_dir))
+        if source.store:
+            log.info('Store of "%s" is "%s"' % (source.name,
+                     source.store.filename))
+        if source.rollups:
+            log.info('Rollups of "%s" are in "%s"' % (source.name,
+                     source.rollups.filename))
+
+    cache = None
+    if args.cache:
+        cache = ImageCache(args.cache, version=ocr_version())
+        log.info('Cache file is "%s"' % cache.filename)
+
+    publisher = None
+    if args.webhook or args.sse_port:
+        try:
+            webhooks = [Webhook(url) for url in args.webhook]
+        except ValueError as e:
+            log.error(e)
+            sys.exit(1)
+        stream = None
+        if args.sse_port:
+            stream = EventStream(metrics=metrics)
+            server = make_server(stream, args.sse_host, args.sse_port)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            log.info('Streaming events on http://%s:%d' % (args.sse_host,
+                     args.sse_port))
+        publisher = Publisher(webhooks, stream, metrics=metrics)
+
+    def run(sources):
+        """
+        Run ``update_sources`` and record the outcome in the metrics.
+
+        Returns a dictionary which maps source names to measurement
+        dates (``None`` if an error occurred).
+        """
+        try:
+            dates = update_sources(sources, args.concurrency, cache, publisher)
+        except Exception as e:
+            log.exception(e)
+            dates = dict((source.name, None) for source in sources)
+        for name, date in dates.iteritems():
+            if date is None:
+                metrics.inc('runs_total', result='error', source=name)
+            else:
+                metrics.inc('runs_total', result='success', source=name)
+                metrics.set('last_success_timestamp_seconds', int(time.time()),
+                            source=name)
+        if args.metrics:
+            try:
+                metrics.write_textfile(args.metrics)
+            except Exception as e:
+                log.exception(e)
+        return dates
+
+    if args.daemon:
+        # Each source is polled on its own schedule
+        schedulers = dict((source.name, PollScheduler(args.min_interval,
+                                                      args.max_interval))
+                          for source in SOURCES)
+        next_poll = dict((source.name, 0) for source in SOURCES)
+        try:
+            while True:
+                now = time.time()
+                dates = run([source for source in SOURCES
+                             if next_poll[source.name] <= now])
+                for name, date in dates.iteritems():
+                    scheduler = schedulers[name]
+                    if date is None:
+                        scheduler.fail()
+                    else:
+                        scheduler.observe(date)
+                    next_poll[name] = time.time() + scheduler.next_delay()
+                delay = max(0, min(next_poll.itervalues()) - time.time())
+                log.info('Next poll in %d seconds', delay)
+                time.sleep(delay)
+        except KeyboardInterrupt:
+            pass
+    else:
+        run(SOURCES)
 
+    if publisher:
+        publisher.close()
     log.info('Finished')
@@ -0,0 +1,530 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+# Copyright (c) 2015 Code for Karlsruhe (http://codefor.de/karlsruhe)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+HTTP API for scraped measurements.
+
+The measurements are loaded from a JSON directory or a measurement
+database into an in-memory index, which is refreshed periodically. The
+following resources are provided:
+
+``/latest``
+    The most recent measurement.
+
+``/range?from=DATE&to=DATE&indicator=NAME``
+    The values of one or more indicators in a date range. ``from`` is
+    inclusive and ``to`` is exclusive, both are optional and may be
+    abbreviated (e.g. ``2015-06``). ``indicator`` may be repeated and
+    defaults to all indicators.
+
+Both resources are available as JSON (the default) and as CSV (by
+passing ``format=csv``).
+"""
+
+import array
+import bisect
+import collections
+import cStringIO
+import csv
+import glob
+import json
+import logging
+import os
+import os.path
+import socket
+import SocketServer
+import sys
+import threading
+import urlparse
+import wsgiref.simple_server
+
+from partitions import list_partitions, PARTITION_SUFFIX, read_partition
+from store import JSON_PREFIX, JSON_SUFFIX, MeasurementStore, read_json
+
+
+log = logging.getLogger('codeforka-trinkwasser.serve')
+
+
+# Interval (in seconds) in which the index is refreshed
+REFRESH_INTERVAL = 60
+
+# Maximum number of rendered responses that are kept in memory
+RESPONSE_CACHE_SIZE = 256
+
+
+class MeasurementIndex(object):
+    """
+    In-memory index of measurements.
+
+    The measurement dates are kept in a sorted list and the values of
+    each indicator are kept in an array of floats which is aligned with
+    that list. Missing values are stored as NaN.
+
+    Instances can be shared between threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._dates = []
+        self._columns = collections.OrderedDict()
+        self._units = {}
+        self.version = 0
+
+    def __len__(self):
+        return len(self._dates)
+
+    def add(self, date, values):
+        """
+        Add a measurement to the index.
+
+        ``date`` is the measurement date and ``values`` is a dictionary
+        of values as returned by ``scrape.scrape``. Existing values for
+        the same date are replaced.
+        """
+        with self._lock:
+            for name in sorted(values):
+                if name not in self._columns:
+                    self._columns[name] = array.array(
+                            'd', [float('nan')] * len(self._dates))
+            index = bisect.bisect_left(self._dates, date)
+            if index == len(self._dates) or self._dates[index] != date:
+                self._dates.insert(index, date)
+                for column in self._columns.itervalues():
+                    column.insert(index, float('nan'))
+            for name, value in values.iteritems():
+                self._columns[name][index] = value['value']
+                self._units[name] = value['unit']
+            self.version += 1
+
+    def indicators(self):
+        """
+        Get the names of the indicators.
+        """
+        with self._lock:
+            return self._columns.keys()
+
+    def unit(self, indicator):
+        """
+        Get the unit of an indicator.
+        """
+        return self._units[indicator]
+
+    def last_date(self):
+        """
+        Get the most recent measurement date or ``None``.
+        """
+        with self._lock:
+            if not self._dates:
+                return None
+            return self._dates[-1]
+
+    def latest(self):
+        """
+        Get the most recent measurement.
+
+        Returns a 2-tuple of date and values or ``None`` if the index is
+        empty.
+        """
+        with self._lock:
+            if not self._dates:
+                return None
+            values = {}
+            for name, column in self._columns.iteritems():
+                value = column[-1]
+                if value == value:  # Not NaN
+                    values[name] = {'value': value, 'unit': self._units[name]}
+            return self._dates[-1], values
+
+    def range(self, indicators, start=None, end=None):
+        """
+        Get the values of some indicators in a date range.
+
+        ``start`` (inclusive) and ``end`` (exclusive) are measurement
+        dates or prefixes thereof. If they are ``None`` then the range
+        is unbounded.
+
+        Returns a 2-tuple containing the list of dates in the range and
+        a dictionary that maps each indicator to the list of its values
+        for these dates (``None`` for missing values). A ``KeyError`` is
+        raised for unknown indicators.
+        """
+        with self._lock:
+            lo = 0 if start is None else bisect.bisect_left(self._dates, start)
+            hi = (len(self._dates) if end is None
+                  else bisect.bisect_left(self._dates, end))
+            dates = self._dates[lo:hi]
+            values = {}
+            for name in indicators:
+                values[name] = [v if v == v else None
+                                for v in self._columns[name][lo:hi]]
+            return dates, values
+
+
+class DirectoryLoader(object):
+    """
+    Incrementally load measurements from a JSON directory.
+
+    Both individual JSON files and partition files (see ``partitions``)
+    are loaded. Partition files are re-read when they have changed.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._known = set()
+        self._partitions = {}
+        self._dates = set()
+        self._invalid = set()
+        self._state = None
+
+    def _get_state(self):
+        """
+        Get a value that changes whenever the directory's content does.
+
+        New and replaced files change the modification time of the
+        directory, but uncompressed partition files are appended to in
+        place, so their sizes and modification times are included.
+        """
+        state = [os.stat(self.directory).st_mtime]
+        pattern = os.path.join(self.directory,
+                               JSON_PREFIX + '*' + PARTITION_SUFFIX)
+        for filename in sorted(glob.glob(pattern)):
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                # Removed meanwhile, which changes the directory, too
+                continue
+            state.append((filename, stat.st_size, stat.st_mtime))
+        return state
+
+    def load(self):
+        """
+        Load the measurements that have not been loaded before.
+
+        Files which cannot be read (e.g. because they are incomplete) are
+        skipped with a warning and retried on the next call.
+
+        Returns a list of 2-tuples of date and values.
+        """
+        state = self._get_state()
+        if state == self._state:
+            return []
+        complete = True
+        pattern = os.path.join(self.directory, JSON_PREFIX + '*' + JSON_SUFFIX)
+        measurements = []
+        for filename in sorted(set(glob.glob(pattern)) - self._known):
+            try:
+                date, values = read_json(filename)
+            except (IOError, ValueError, KeyError) as e:
+                self._skip(filename, e)
+                complete = False
+                continue
+            measurements.append((date, values))
+            self._known.add(filename)
+            self._dates.add(date)
+            self._invalid.discard(filename)
+        for key, filenames in list_partitions(self.directory):
+            try:
+                files = [(filename, os.stat(filename).st_mtime,
+                          os.path.getsize(filename)) for filename in filenames]
+            except OSError as e:
+                # Removed meanwhile, e.g. because it has been compressed
+                self._skip(key, e)
+                complete = False
+                continue
+            if self._partitions.get(key) == files:
+                continue
+            self._partitions[key] = files
+            for date, values in read_partition(filenames).iteritems():
+                if date not in self._dates:
+                    measurements.append((date, values))
+                    self._dates.add(date)
+        # Unless something has been skipped, the directory only has to be
+        # scanned again once it has changed
+        if complete:
+            self._state = state
+        return measurements
+
+    def _skip(self, name, error):
+        if name not in self._invalid:
+            log.warning('Skipping "%s": %s', name, error)
+            self._invalid.add(name)
+
+
+class StoreLoader(object):
+    """
+    Incrementally load measurements from a measurement database.
+    """
+
+    def __init__(self, filename):
+        self.store = MeasurementStore(filename)
+        self._last = None
+
+    def load(self):
+        """
+        Load the measurements that are newer than the ones loaded before.
+
+        Returns a list of 2-tuples of date and values.
+        """
+        measurements = [(date, values) for date, values
+                        in self.store.iter_measurements(self._last)
+                        if date != self._last]
+        if measurements:
+            self._last = measurements[-1][0]
+        return measurements
+
+
+def refresh(index, loader):
+    """
+    Add new measurements from a loader to an index.
+
+    Returns the number of new measurements.
+    """
+    measurements = loader.load()
+    for date, values in measurements:
+        index.add(date, values)
+    return len(measurements)
+
+
+class API(object):
+    """
+    WSGI application serving the contents of a ``MeasurementIndex``.
+
+    Rendered responses are cached until the index changes. Responses
+    carry an ``ETag`` derived from the index version, so that clients
+    can revalidate them using ``If-None-Match``.
+    """
+
+    def __init__(self, index, cache_size=RESPONSE_CACHE_SIZE):
+        self.index = index
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._cache_version = None
+        self._cache_lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        query = environ.get('QUERY_STRING', '')
+        version = self.index.version
+        etag = '"%d-%s"' % (version, str(self.index.last_date()))
+        if etag in environ.get('HTTP_IF_NONE_MATCH', ''):
+            start_response('304 Not Modified', [('ETag', etag)])
+            return []
+        try:
+            content_type, body = self._get_cached(version, path, query)
+        except _HTTPError as e:
+            start_response(e.status, [('Content-Type', 'text/plain')])
+            return [e.text]
+        start_response('200 OK', [
+            ('Content-Type', content_type),
+            ('Content-Length', str(len(body))),
+            ('ETag', etag),
+            ('Access-Control-Allow-Origin', '*'),
+        ])
+        return [body]
+
+    def _get_cached(self, version, path, query):
+        key = (path, query)
+        with self._cache_lock:
+            if self._cache_version != version:
+                self._cache.clear()
+                self._cache_version = version
+            try:
+                response = self._cache.pop(key)
+                self._cache[key] = response
+                return response
+            except KeyError:
+                pass
+        response = self._render(path, urlparse.parse_qs(query))
+        with self._cache_lock:
+            if self._cache_version == version:
+                self._cache[key] = response
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return response
+
+    def _render(self, path, params):
+        fmt = params.get('format', ['json'])[0]
+        if fmt not in ('json', 'csv'):
+            raise _HTTPError('400 Bad Request', 'Unknown format "%s"' % fmt)
+        if path == '/latest':
+            latest = self.index.latest()
+            if latest is None:
+                raise _HTTPError('404 Not Found', 'No measurements')
+            date, values = latest
+            if fmt == 'json':
+                return _json({'date': date, 'values': values})
+            rows = [[date, name, value['value'], value['unit']]
+                    for name, value in sorted(values.iteritems())]
+            return _csv(['date', 'indicator', 'value', 'unit'], rows)
+        if path == '/range':
+            indicators = params.get('indicator') or self.index.indicators()
+            start = params.get('from', [None])[0]
+            end = params.get('to', [None])[0]
+            try:
+                dates, values = self.index.range(indicators, start, end)
+            except KeyError as e:
+                raise _HTTPError('404 Not Found', 'Unknown indicator %s' % e)
+            if fmt == 'json':
+                return _json({
+                    'dates': dates,
+                    'indicators': dict((name, {
+                        'unit': self.index.unit(name),
+                        'values': values[name],
+                    }) for name in indicators),
+                })
+            columns = [values[name] for name in indicators]
+            return _csv(['date'] + list(indicators), zip(dates, *columns))
+        raise _HTTPError('404 Not Found', 'Not found')
+
+
+class _HTTPError(Exception):
+
+    def __init__(self, status, text):
+        super(_HTTPError, self).__init__(status, text)
+        self.status = status
+        self.text = text
+
+
+def _json(data):
+    return 'application/json', json.dumps(data, separators=(',', ':'))
+
+
+def _csv(header, rows):
+    buf = cStringIO.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow([_encode(v) for v in row])
+    return 'text/csv; charset=utf-8', buf.getvalue()
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    return value
+
+
+class _Server(SocketServer.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients which disconnect (e.g. from an event stream) are no error
+        if not isinstance(sys.exc_info()[1], socket.error):
+            wsgiref.simple_server.WSGIServer.handle_error(self, request,
+                                                          client_address)
+
+
+class _ServerHandler(wsgiref.simple_server.ServerHandler):
+    def log_exception(self, exc_info):
+        if not isinstance(exc_info[1], socket.error):
+            wsgiref.simple_server.ServerHandler.log_exception(self, exc_info)
+
+
+class _QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        # Like the base implementation but with ``_ServerHandler``
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.send_error(414)
+            return
+        if not self.parse_request():
+            return
+        handler = _ServerHandler(self.rfile, self.wfile, self.get_stderr(),
+                                 self.get_environ())
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+
+def make_server(app, host='localhost', port=0):
+    """
+    Create a multi-threaded WSGI server for an application.
+
+    If ``port`` is 0 then a free port is chosen. Returns the server,
+    call its ``serve_forever`` method to run it.
+    """
+    return wsgiref.simple_server.make_server(host, port, app, _Server,
+                                             _QuietHandler)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+            description=__doc__.strip().split('\n', 1)[0])
+    parser.add_argument('source', nargs='?',
+                        help='JSON directory from which data is loaded')
+    parser.add_argument('--store', metavar='FILE',
+                        help='Measurement database from which data is loaded')
+    parser.add_argument('--host', default='localhost',
+                        help='Host to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='Port to listen on (default: %(default)s)')
+    parser.add_argument('--refresh', type=float, default=REFRESH_INTERVAL,
+                        help='Refresh interval in seconds ' +
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] <%(levelname)s> %(message)s')
+
+    if args.store:
+        loader = StoreLoader(args.store)
+    elif args.source:
+        loader = DirectoryLoader(args.source)
+    else:
+        sys.exit('Either a JSON directory or a database must be given.')
+
+    index = MeasurementIndex()
+    try:
+        log.info('Loaded %d measurements', refresh(index, loader))
+    except Exception as e:
+        log.exception(e)
+
+    def refresh_periodically():
+        while True:
+            stop.wait(args.refresh)
+            if stop.is_set():
+                return
+            try:
+                count = refresh(index, loader)
+                if count:
+                    log.info('Loaded %d new measurements', count)
+            except Exception as e:
+                log.exception(e)
+
+    stop = threading.Event()
+    refresher = threading.Thread(target=refresh_periodically)
+    refresher.daemon = True
+    refresher.start()
+
+    server = make_server(API(index), args.host, args.port)
+    log.info('Listening on http://%s:%d' % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
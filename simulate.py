@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+# Copyright (c) 2015 Code for Karlsruhe (http://codefor.de/karlsruhe)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Simulated image server for load tests.
+
+The simulator speaks the same interface as the image script of the
+Stadtwerke Karlsruhe (see ``scrape.IMAGE_URL``): ``/cgi-bin/gd?h=H&w=W&wert=KEY``
+returns a PNG image of the given size which shows the current value of
+indicator ``KEY`` or, for ``scrape.DATE_KEY``, the date of the current
+measurement. The characters are drawn from ``scrape.CLASSES``, so that
+they are recognized just like those of the real images.
+
+A new measurement is published every ``interval`` seconds. Its values
+drift randomly from those of the previous one. Responses can be delayed
+and a share of the requests can be answered with server errors.
+"""
+
+import datetime
+import hashlib
+import random
+import struct
+import threading
+import time
+import urlparse
+import zlib
+
+from scrape import CLASSES, DATE_KEY, MONTH_NAMES
+from serve import make_server
+
+
+# Horizontal space between characters and width of the space character
+# (in pixels)
+GAP = 2
+SPACE_WIDTH = 8
+
+# Base value and number of decimal places of each indicator
+INDICATORS = {
+    'w1': (12.0, 1),   # Temperature
+    'w2': (7.6, 2),    # pH
+    'w3': (645.0, 0),  # Conductivity
+    'w4': (0.05, 2),   # Turbidity
+    'w5': (9.8, 1),    # Oxygen
+    'w6': (12.4, 1),   # Nitrate
+}
+
+# Format of the date label
+DATE_LABEL = 'Stand: %02d %s %02d %02d:%02d'
+
+# Date of the first measurement and time between measurements
+START_DATE = datetime.datetime(2015, 9, 21, 10, 0)
+MEASUREMENT_STEP = datetime.timedelta(hours=1)
+
+# Maximum number of rendered images that are kept in memory
+RENDER_CACHE_SIZE = 256
+
+
+def text_size(text):
+    """
+    Get the width and height of rendered text.
+
+    The height is that of the font's character cells.
+    """
+    glyphs = dict((glyph.char, glyph) for glyph in CLASSES.glyphs())
+    width = (sum(glyphs[char].signature[0] or SPACE_WIDTH for char in text) +
+             GAP * (len(text) - 1))
+    height = max(glyph.top + glyph.signature[1] for glyph in glyphs.itervalues())
+    return width, height
+
+
+def _chunk(kind, data):
+    return (struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+
+def render(text, width, height):
+    """
+    Render text into a PNG image.
+
+    The image has a black border like the real images and the text is
+    centered within it. Like images created by gd it uses a palette
+    with one bit per pixel. Returns the PNG data as a string.
+    """
+    glyphs = dict((glyph.char, glyph) for glyph in CLASSES.glyphs())
+    text_width, text_height = text_size(text)
+    # The scraper cuts off one pixel at the left and top and two at the
+    # right and bottom (see ``scrape.BORDER``)
+    x0 = 1 + (width - 3 - text_width) // 2
+    y0 = 1 + (height - 3 - text_height) // 2
+    pixels = [bytearray('1' * width) for _ in xrange(height)]
+    for row in (pixels[0], pixels[-1]):
+        row[:] = '0' * width
+    for row in pixels:
+        row[0] = row[-1] = '0'
+    left = x0
+    for char in text:
+        glyph = glyphs[char]
+        glyph_width, glyph_height, bits = glyph.signature
+        for index in xrange(glyph_width * glyph_height):
+            if bits >> index & 1:
+                x = left + index % glyph_width
+                y = y0 + glyph.top + index // glyph_width
+                if 0 <= x < width and 0 <= y < height:
+                    pixels[y][x] = '0'
+        left += (glyph_width or SPACE_WIDTH) + GAP
+    padding = '1' * (-width % 8)
+    raw = []
+    for row in pixels:
+        row = str(row) + padding
+        raw.append('\x00' + ''.join(chr(int(row[i:i + 8], 2))
+                                    for i in xrange(0, len(row), 8)))
+    return ('\x89PNG\r\n\x1a\n' +
+            _chunk('IHDR', struct.pack('>IIBBBBB', width, height, 1, 3, 0, 0, 0)) +
+            _chunk('PLTE', '\x00\x00\x00\xff\xff\xff') +
+            _chunk('IDAT', zlib.compress(''.join(raw))) +
+            _chunk('IEND', ''))
+
+
+class Simulator(object):
+    """
+    WSGI application which simulates the image server.
+
+    ``latency`` is the mean delay of the responses in seconds (the
+    delays are exponentially distributed, so some are much longer) and
+    ``error_rate`` the share of requests which are answered with status
+    503. ``drift`` is the standard deviation of the relative change of
+    each value between measurements, and a new measurement is published
+    every ``interval`` seconds. ``seed`` makes the values reproducible.
+
+    The numbers of requests and errors are counted in ``requests`` and
+    ``errors``.
+    """
+
+    def __init__(self, latency=0, error_rate=0, drift=0.01, interval=60,
+                 seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.drift = drift
+        self.interval = interval
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._start = time.time()
+        self._index = 0
+        self._values = dict((key, value) for key, (value, _)
+                            in INDICATORS.iteritems())
+        self._images = {}
+
+    def measurement(self):
+        """
+        Get the current measurement.
+
+        Returns a 2-tuple of the measurement's date (a
+        ``datetime.datetime`` instance) and a dictionary which maps
+        image keys to the values as displayed.
+        """
+        with self._lock:
+            if self.interval:
+                index = int((time.time() - self._start) / self.interval)
+            else:
+                index = 0
+            while self._index < index:
+                self._index += 1
+                for key, value in self._values.iteritems():
+                    self._values[key] = abs(value * (1 + self._random.gauss(
+                                                     0, self.drift)))
+            values = dict((key, '%.*f' % (INDICATORS[key][1], value))
+                          for key, value in self._values.iteritems())
+            return START_DATE + index * MEASUREMENT_STEP, values
+
+    def _render(self, text, width, height):
+        key = (text, width, height)
+        try:
+            return self._images[key]
+        except KeyError:
+            pass
+        data = render(text, width, height)
+        if len(self._images) >= RENDER_CACHE_SIZE:
+            self._images.clear()
+        self._images[key] = data
+        return data
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            self.requests += 1
+            delay = self._random.expovariate(1.0 / self.latency) if self.latency else 0
+            error = self._random.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        if error:
+            with self._lock:
+                self.errors += 1
+            start_response('503 Service Unavailable',
+                           [('Content-Type', 'text/plain')])
+            return ['Simulated error\n']
+        if environ.get('PATH_INFO') != '/cgi-bin/gd':
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ['Not found\n']
+        params = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+        try:
+            key = params['wert'][0]
+            width = int(params['w'][0])
+            height = int(params['h'][0])
+            if not (0 < width <= 1000 and 0 < height <= 1000):
+                raise ValueError(width, height)
+        except (KeyError, ValueError):
+            start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+            return ['Invalid parameters\n']
+        date, values = self.measurement()
+        if key == DATE_KEY:
+            text = DATE_LABEL % (date.day, MONTH_NAMES[date.month - 1],
+                                 date.year % 100, date.hour, date.minute)
+        elif key in values:
+            text = values[key]
+        else:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ['Unknown key\n']
+        data = self._render(text, width, height)
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        headers = [('ETag', etag)]
+        if environ.get('HTTP_IF_NONE_MATCH') == etag:
+            start_response('304 Not Modified', headers)
+            return []
+        headers.extend([('Content-Type', 'image/png'),
+                        ('Content-Length', str(len(data)))])
+        start_response('200 OK', headers)
+        return [data]
+
+
+def image_url(server):
+    """
+    Get the image URL template (see ``scrape.IMAGE_URL``) of a server.
+    """
+    host, port = server.server_address[:2]
+    return 'http://%s:%d/cgi-bin/gd?h=%%d&w=%%d&wert=%%s' % (host, port)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+            description=__doc__.strip().split('\n', 1)[0])
+    parser.add_argument('--host', default='localhost',
+                        help='Host to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='Port to listen on (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Mean response delay in seconds ' +
+                             '(default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Share of requests that fail ' +
+                             '(default: %(default)s)')
+    parser.add_argument('--drift', type=float, default=0.01,
+                        help='Relative standard deviation of the value ' +
+                             'changes (default: %(default)s)')
+    parser.add_argument('--interval', type=float, default=60,
+                        help='Seconds between measurements ' +
+                             '(default: %(default)s)')
+    parser.add_argument('--seed', type=int, help='Random seed')
+    args = parser.parse_args()
+
+    simulator = Simulator(args.latency, args.error_rate, args.drift,
+                          args.interval, args.seed)
+    server = make_server(simulator, args.host, args.port)
+    print 'Serving images at %s' % image_url(server)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
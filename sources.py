@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+# Copyright (c) 2015 Code for Karlsruhe (http://codefor.de/karlsruhe)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Registry of data sources.
+
+A source is a website which publishes measurements as images rendered by
+the same GD-based widget as the homepage of the Stadtwerke Karlsruhe.
+Sources are defined in a JSON configuration file::
+
+    {
+        "sources": [
+            {
+                "name": "karlsruhe",
+                "url": "http://www.example.com/cgi-bin/gd?h=%d&w=%d&wert=%s",
+                "values": {
+                    "w1": ["temperature", "°C"],
+                    "w2": ["ph", ""]
+                },
+                "value_size": [70, 50],
+                "date_key": "w9",
+                "date_size": [300, 20],
+                "output_dir": "data/karlsruhe",
+                "partition": "day",
+                "compress": true,
+                "store": "data/karlsruhe.sqlite",
+                "rollups": "data/karlsruhe-rollups.sqlite"
+            }
+        ],
+        "hosts": {
+            "www.example.com": {"max_connections": 2, "rate": 1}
+        }
+    }
+
+``url`` is a format string into which the height, the width and the key
+of an image are inserted. ``values`` maps the keys of the indicator
+images to the indicators' names and units. Only ``name``, ``url`` and
+``values`` are required; each source needs an output directory, a store
+or both. Relative paths are relative to the configuration file.
+``partition`` and ``compress`` select partitioned storage in the output
+directory (see ``partitions``). ``rollups`` is a database in which
+aggregates of the values are maintained (see ``rollups``).
+
+``hosts`` optionally sets the maximum number of simultaneous connections
+and of requests per second for individual hosts (see
+``fetch.set_host_limits``).
+"""
+
+import codecs
+import json
+import os.path
+import urlparse
+
+from partitions import PERIODS
+from rollups import Rollups
+from store import MeasurementStore
+
+
+# Default dimensions of the indicator images and key and dimensions of
+# the date image
+VALUE_SIZE = (70, 50)
+DATE_KEY = 'w9'
+DATE_SIZE = (300, 20)
+
+# Limits which can be set for a host (the keyword arguments of
+# ``fetch.set_host_limits``)
+HOST_LIMITS = ('max_connections', 'rate')
+
+
+class Source(object):
+    """
+    A data source.
+
+    ``url`` is the format string for the image URLs and ``values`` maps
+    image keys to 2-tuples of indicator name and unit (see the module
+    documentation). The scraped data is written to ``output_dir`` (a
+    directory for JSON files) and/or ``store`` (a
+    ``store.MeasurementStore`` instance). If ``partition`` is ``'day'``
+    or ``'month'`` then the measurements are appended to partition files
+    in the output directory, which are compressed once complete if
+    ``compress`` is true (see ``partitions.append_measurement``). New
+    measurements are aggregated in ``rollups`` (a ``rollups.Rollups``
+    instance) if it is given.
+    """
+
+    def __init__(self, name, url, values, value_size=VALUE_SIZE,
+                 date_key=DATE_KEY, date_size=DATE_SIZE, output_dir=None,
+                 store=None, partition=None, compress=False, rollups=None):
+        if partition is not None and partition not in PERIODS:
+            raise ValueError('Invalid partition period "%s"' % partition)
+        self.name = name
+        self.url = url
+        self.values = values
+        self.value_size = tuple(value_size)
+        self.date_key = str(date_key)
+        self.date_size = tuple(date_size)
+        self.output_dir = output_dir
+        self.store = store
+        self.partition = str(partition) if partition else None
+        self.compress = compress
+        self.rollups = rollups
+
+    def __repr__(self):
+        return '<Source %r>' % self.name
+
+    @property
+    def host(self):
+        """
+        The name of the host serving the source's images.
+        """
+        return urlparse.urlsplit(self.url).hostname
+
+    def image_url(self, key, width, height):
+        """
+        Get the URL of an image.
+        """
+        return self.url % (height, width, key)
+
+
+def load_config(filename):
+    """
+    Load a configuration file.
+
+    The stores and rollup databases of the sources are opened. Returns a
+    list of ``Source`` instances and a dictionary which maps host names
+    to dictionaries of keyword arguments for ``fetch.set_host_limits``.
+
+    Raises ``ValueError`` if the configuration is invalid.
+    """
+    with codecs.open(filename, 'r', encoding='utf8') as f:
+        config = json.load(f)
+    base = os.path.dirname(os.path.abspath(filename))
+
+    def path(value):
+        if value is None:
+            return None
+        return os.path.join(base, value)
+
+    sources = []
+    names = set()
+    outputs = set()
+    for options in config.get('sources', []):
+        options = dict((str(key), value) for key, value in options.iteritems())
+        try:
+            name = options.pop('name')
+            url = str(options.pop('url'))
+            values = dict((str(key), tuple(value))
+                          for key, value in options.pop('values').iteritems())
+        except KeyError as e:
+            raise ValueError('Source option "%s" is missing' % e.args[0])
+        if name in names:
+            raise ValueError('Duplicate source "%s"' % name)
+        names.add(name)
+        output_dir = path(options.pop('output_dir', None))
+        store = path(options.pop('store', None))
+        rollups = path(options.pop('rollups', None))
+        if not (output_dir or store):
+            raise ValueError('Source "%s" has neither output directory nor '
+                             'store' % name)
+        for output in set([output_dir, store, rollups]):
+            if output in outputs:
+                raise ValueError('Output "%s" is used by several sources' %
+                                 output)
+            if output:
+                outputs.add(output)
+        try:
+            source = Source(name, url, values, output_dir=output_dir,
+                            store=store, rollups=rollups, **options)
+        except (TypeError, ValueError) as e:
+            raise ValueError('Invalid options for source "%s": %s' % (name, e))
+        sources.append(source)
+    hosts = {}
+    for host, limits in config.get('hosts', {}).iteritems():
+        limits = dict((str(key), value) for key, value in limits.iteritems())
+        for key in limits:
+            if key not in HOST_LIMITS:
+                raise ValueError('Unknown limit "%s" for host "%s"' %
+                                 (key, host))
+        max_connections = limits.get('max_connections', 1)
+        if not isinstance(max_connections, int) or max_connections < 1:
+            raise ValueError('Invalid maximum number of connections for '
+                             'host "%s"' % host)
+        rate = limits.get('rate')
+        if rate is not None and (not isinstance(rate, (int, float)) or
+                                 rate <= 0):
+            raise ValueError('Invalid rate for host "%s"' % host)
+        hosts[host] = limits
+    for source in sources:
+        if source.store:
+            source.store = MeasurementStore(source.store)
+        if source.rollups:
+            source.rollups = Rollups(source.rollups)
+    return sources, hosts
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+# Copyright (c) 2015 Code for Karlsruhe (http://codefor.de/karlsruhe)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Storage of scraped measurements.
+
+Measurements can be stored in two ways: As a directory with one JSON
+file per measurement (plus a ``latest.json`` symlink to the most recent
+one) or in an SQLite database which is indexed by indicator and date
+and therefore supports fast range queries.
+
+Measurement dates are strings in the format given by ``DATE_FORMAT``,
+which sort chronologically.
+"""
+
+import codecs
+import errno
+import glob
+import json
+import os
+import os.path
+import tempfile
+
+
+DATE_FORMAT = '%Y-%m-%d-%H-%M-00'
+
+JSON_PREFIX = 'karlsruhe-drinking-water-'
+JSON_SUFFIX = '.json'
+JSON_LATEST = 'latest.json'
+
+# Lock file of a JSON directory (see ``lock.FileLock``)
+JSON_LOCK = '.lock'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS measurements (
+    indicator TEXT NOT NULL,
+    date TEXT NOT NULL,
+    value REAL NOT NULL,
+    unit TEXT NOT NULL,
+    PRIMARY KEY (indicator, date)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS measurements_date ON measurements (date);
+'''
+
+
+def _temp_name(filename):
+    """
+    Get a unique temporary name in the directory of ``filename``.
+    """
+    directory, name = os.path.split(os.path.abspath(filename))
+    return tempfile.mktemp(prefix='.%s.' % name, suffix='.tmp', dir=directory)
+
+
+def write_atomic(filename, data):
+    """
+    Atomically replace the content of a file.
+
+    The data is written to a temporary file which is then renamed, so
+    that readers never see an incomplete file, not even if the writing
+    process crashes.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, temp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(temp, 0644)
+        os.rename(temp, filename)
+    except:
+        os.remove(temp)
+        raise
+
+
+def symlink(target, filename):
+    """
+    Create a symlink.
+
+    An existing file of the same name is atomically replaced.
+    """
+    while True:
+        temp = _temp_name(filename)
+        try:
+            os.symlink(target, temp)
+            break
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    try:
+        os.rename(temp, filename)
+    except:
+        os.remove(temp)
+        raise
+
+
+def json_filename(directory, date):
+    """
+    Get the name of the JSON file for a measurement.
+    """
+    return os.path.join(directory, JSON_PREFIX + date + JSON_SUFFIX)
+
+
+def write_json(directory, date, values, latest=True):
+    """
+    Store a measurement as a JSON file.
+
+    ``date`` is the measurement date and ``values`` is a dictionary of
+    values as returned by ``scrape.scrape``. The file is written to
+    ``directory``. If ``latest`` is true then the ``latest.json``
+    symlink in that directory is updated to point to it. Both are
+    replaced atomically.
+    """
+    filename = json_filename(directory, date)
+    data = json.dumps({'date': date, 'values': values}, separators=(',',':'))
+    write_atomic(filename, data.encode('utf8'))
+    if latest:
+        symlink(os.path.basename(filename),
+                os.path.join(directory, JSON_LATEST))
+
+
+def read_json(filename):
+    """
+    Load a measurement from a JSON file.
+
+    Returns the measurement date and the dictionary of values.
+    """
+    with codecs.open(filename, 'r', encoding='utf8') as f:
+        data = json.load(f)
+    return data['date'], data['values']
+
+
+def iter_json(directory):
+    """
+    Iterate over the measurements stored in a JSON directory.
+
+    Yields 2-tuples of measurement date and dictionary of values in
+    chronological order.
+    """
+    filenames = glob.glob(os.path.join(directory, JSON_PREFIX + '*' + JSON_SUFFIX))
+    for filename in sorted(filenames):
+        yield read_json(filename)
+
+
+def _text(s):
+    """
+    Convert a UTF-8 encoded byte string to unicode.
+    """
+    if isinstance(s, str):
+        return s.decode('utf8')
+    return s
+
+
+class MeasurementStore(object):
+    """
+    SQLite database of measurements.
+
+    The database uses write-ahead logging so that it can be read while
+    the scraper writes to it. Each value is stored in a separate row
+    keyed by indicator and date.
+    """
+
+    def __init__(self, filename):
+        # Not imported at module level because importing it slows down
+        # the start of the scraper, which only needs it with ``--store``
+        import sqlite3
+        self.filename = filename
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        """
+        Close the database.
+        """
+        self._db.close()
+
+    def add(self, date, values):
+        """
+        Store a measurement.
+
+        ``date`` is the measurement date and ``values`` is a dictionary
+        of values as returned by ``scrape.scrape``. Existing values for
+        the same date are replaced.
+        """
+        self.add_many([(date, values)])
+
+    def add_many(self, measurements):
+        """
+        Store several measurements in a single transaction.
+
+        ``measurements`` is an iterable of 2-tuples of date and values
+        (see ``add``).
+
+        Returns the number of stored measurements.
+        """
+        count = 0
+        with self._db:
+            for date, values in measurements:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO measurements VALUES (?, ?, ?, ?)',
+                    [(_text(name), _text(date), value['value'],
+                      _text(value['unit']))
+                     for name, value in values.iteritems()])
+                count += 1
+        return count
+
+    def has(self, date):
+        """
+        Check whether a measurement is stored.
+        """
+        cursor = self._db.execute(
+                'SELECT 1 FROM measurements WHERE date = ? LIMIT 1', (date,))
+        return cursor.fetchone() is not None
+
+    def get(self, date):
+        """
+        Get a measurement's values.
+
+        Returns a dictionary of values as returned by ``scrape.scrape``,
+        which is empty if there is no measurement for ``date``.
+        """
+        cursor = self._db.execute(
+                'SELECT indicator, value, unit FROM measurements WHERE date = ?',
+                (date,))
+        return dict((name, {'value': value, 'unit': unit})
+                    for name, value, unit in cursor)
+
+    def latest(self):
+        """
+        Get the most recent measurement.
+
+        Returns a 2-tuple of date and values or ``None`` if the store is
+        empty.
+        """
+        row = self._db.execute('SELECT MAX(date) FROM measurements').fetchone()
+        if row[0] is None:
+            return None
+        return row[0], self.get(row[0])
+
+    def indicators(self):
+        """
+        Get the names of all stored indicators.
+        """
+        cursor = self._db.execute('SELECT DISTINCT indicator FROM measurements')
+        return sorted(row[0] for row in cursor)
+
+    def range(self, indicator, start=None, end=None):
+        """
+        Get the values of an indicator in a date range.
+
+        ``start`` (inclusive) and ``end`` (exclusive) are measurement
+        dates. If they are ``None`` then the range is unbounded.
+
+        Returns a list of 2-tuples of date and value in chronological
+        order.
+        """
+        query = 'SELECT date, value FROM measurements WHERE indicator = ?'
+        params = [indicator]
+        if start is not None:
+            query += ' AND date >= ?'
+            params.append(start)
+        if end is not None:
+            query += ' AND date < ?'
+            params.append(end)
+        query += ' ORDER BY date'
+        return self._db.execute(query, params).fetchall()
+
+    def iter_measurements(self, start=None, end=None):
+        """
+        Iterate over the stored measurements.
+
+        ``start`` and ``end`` are as for ``range``. Yields 2-tuples of
+        date and values in chronological order.
+        """
+        query = 'SELECT date, indicator, value, unit FROM measurements'
+        conditions = []
+        params = []
+        if start is not None:
+            conditions.append('date >= ?')
+            params.append(start)
+        if end is not None:
+            conditions.append('date < ?')
+            params.append(end)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY date'
+        current = None
+        values = {}
+        for date, name, value, unit in self._db.execute(query, params):
+            if date != current:
+                if current is not None:
+                    yield current, values
+                current = date
+                values = {}
+            values[name] = {'value': value, 'unit': unit}
+        if current is not None:
+            yield current, values
+
+
+if __name__ == '__main__':
+    import argparse
+    import csv
+    import sys
+
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('database', help='SQLite database file')
+    subparsers = parser.add_subparsers(dest='command')
+    import_parser = subparsers.add_parser(
+            'import', help='Import measurements from a JSON directory')
+    import_parser.add_argument('directory', help='JSON directory')
+    export_parser = subparsers.add_parser(
+            'export', help='Export measurements to a JSON directory')
+    export_parser.add_argument('directory', help='JSON directory')
+    query_parser = subparsers.add_parser(
+            'query', help='Print the values of an indicator as CSV')
+    query_parser.add_argument('indicator', help='Indicator name')
+    query_parser.add_argument('--from', dest='start',
+                              help='First date (inclusive)')
+    query_parser.add_argument('--to', dest='end', help='Last date (exclusive)')
+    args = parser.parse_args()
+
+    store = MeasurementStore(args.database)
+    try:
+        if args.command == 'import':
+            count = store.add_many(iter_json(args.directory))
+            print 'Imported %d measurements.' % count
+        elif args.command == 'export':
+            count = 0
+            for date, values in store.iter_measurements():
+                write_json(args.directory, date, values, latest=False)
+                count += 1
+            if count:
+                symlink(os.path.basename(json_filename(args.directory, date)),
+                        os.path.join(args.directory, JSON_LATEST))
+            print 'Exported %d measurements.' % count
+        elif args.command == 'query':
+            writer = csv.writer(sys.stdout)
+            writer.writerow(['date', args.indicator])
+            writer.writerows(store.range(args.indicator, args.start, args.end))
+    finally:
+        store.close()
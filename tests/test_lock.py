@@ -0,0 +1,84 @@
+# vim: set fileencoding=utf-8 :
+
+# Copyright (c) 2015 Code for Karlsruhe (http://codefor.de/karlsruhe)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Tests for ``lock``.
+"""
+
+import json
+import os
+import os.path
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import unittest
+
+import lock
+
+
+class StaleLockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'test.lock')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create_lock(self, pid, host, age):
+        with open(self.filename, 'wb') as f:
+            json.dump({'pid': pid, 'host': host, 'time': time.time() - age,
+                       'token': 'other'}, f)
+        mtime = time.time() - age
+        os.utime(self.filename, (mtime, mtime))
+
+    def assertAcquired(self, acquired):
+        file_lock = lock.FileLock(self.filename, stale_timeout=60)
+        try:
+            file_lock.acquire(timeout=0.5)
+        except lock.LockTimeout:
+            self.assertFalse(acquired)
+        else:
+            file_lock.release()
+            self.assertTrue(acquired)
+
+    def test_old_lock_of_live_process(self):
+        self.create_lock(os.getpid(), socket.gethostname(), 3600)
+        self.assertAcquired(False)
+
+    def test_lock_of_ended_process(self):
+        process = subprocess.Popen(['true'])
+        process.wait()
+        self.create_lock(process.pid, socket.gethostname(), 0)
+        self.assertAcquired(True)
+
+    def test_lock_of_other_host(self):
+        self.create_lock(os.getpid(), 'other.' + socket.gethostname(), 0)
+        self.assertAcquired(False)
+        self.create_lock(os.getpid(), 'other.' + socket.gethostname(), 3600)
+        self.assertAcquired(True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# vim: set fileencoding=utf-8 :
+
+# Copyright (c) 2015 Code for Karlsruhe (http://codefor.de/karlsruhe)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Tests for ``publish``.
+"""
+
+import httplib
+import threading
+import time
+import unittest
+
+import publish
+import serve
+
+
+class WebhookTest(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.server = serve.make_server(self.app)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def app(self, environ, start_response):
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        self.requests.append((environ.get('HTTP_X_SOURCE'),
+                              environ['wsgi.input'].read(length)))
+        start_response('204 No Content', [])
+        return []
+
+    def test_unicode_source(self):
+        url = 'http://localhost:%d/hook' % self.server.server_port
+        payload = publish.format_payload(u'2015-09-21T10:00:00', {})
+        publish.Webhook(url).deliver(payload, u'm\xfchlburg')
+        self.assertEqual(self.requests, [('m\xc3\xbchlburg', payload)])
+
+
+class EventStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = publish.EventStream(keepalive=0.1)
+        self.server = serve.make_server(self.stream)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.conn = httplib.HTTPConnection('localhost',
+                                           self.server.server_port, timeout=5)
+        self.response = None
+
+    def tearDown(self):
+        if self.response:
+            self.response.close()
+        self.conn.close()
+        # The client is removed once its next keep-alive fails
+        deadline = time.time() + 5
+        while self.stream.clients and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.stream.clients, 0)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def connect(self, query):
+        self.conn.request('GET', '/?' + query)
+        self.response = self.conn.getresponse()
+        self.assertEqual(self.response.fp.readline(), ': connected\n')
+
+    def read_event(self, timeout=5):
+        deadline = time.time() + timeout
+        lines = []
+        while True:
+            if time.time() > deadline:
+                self.fail('No event received')
+            line = self.response.fp.readline()
+            if not line:
+                self.fail('Stream closed')
+            if line == '\n':
+                if lines and not lines[0].startswith(':'):
+                    return lines
+                lines = []
+            else:
+                lines.append(line.rstrip('\n'))
+
+    def test_unicode_source(self):
+        self.connect('source=a')
+        self.stream.publish(u'2015-09-21T10:00:00', '{}', u'a')
+        self.assertEqual(self.read_event(),
+                         ['id: 2015-09-21T10:00:00/a', 'data: {}'])
+
+    def test_non_ascii_source(self):
+        self.connect('source=m%C3%BChlburg')
+        self.stream.publish(u'2015-09-21T10:00:00', '{}', u'karlsruhe')
+        self.stream.publish(u'2015-09-21T10:00:00', '{}', u'm\xfchlburg')
+        self.assertEqual(self.read_event(),
+                         ['id: 2015-09-21T10:00:00/m\xc3\xbchlburg',
+                          'data: {}'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+# vim: set fileencoding=utf-8 :
+
+# Copyright (c) 2015 Code for Karlsruhe (http://codefor.de/karlsruhe)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Tests for ``serve``.
+"""
+
+import shutil
+import tempfile
+import unittest
+
+import partitions
+import serve
+
+
+VALUES = {'nitrate': {'value': 12.3, 'unit': 'mg/l'}}
+
+
+class DirectoryLoaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.loader = serve.DirectoryLoader(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_late_append(self):
+        partitions.append_measurement(self.directory, '2015-09-21T12:00:00',
+                                      VALUES)
+        self.assertEqual([date for date, values in self.loader.load()],
+                         ['2015-09-21T12:00:00'])
+        self.assertEqual(self.loader.load(), [])
+        # An older measurement neither creates a file nor updates
+        # ``latest.json``, so the directory itself does not change
+        partitions.append_measurement(self.directory, '2015-09-21T10:00:00',
+                                      VALUES)
+        self.assertEqual(self.loader.load(), [('2015-09-21T10:00:00', VALUES)])
+
+
+if __name__ == '__main__':
+    unittest.main()
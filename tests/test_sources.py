@@ -0,0 +1,71 @@
+# vim: set fileencoding=utf-8 :
+
+# Copyright (c) 2015 Code for Karlsruhe (http://codefor.de/karlsruhe)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Tests for ``sources``.
+"""
+
+import json
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import sources
+
+
+class LoadConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'sources.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def load(self, hosts):
+        config = {
+            'sources': [{
+                'name': 'karlsruhe',
+                'url': 'http://www.example.com/gd?h=%d&w=%d&wert=%s',
+                'values': {'w1': ['temperature', 'mg/l']},
+                'output_dir': 'karlsruhe',
+            }],
+            'hosts': {'www.example.com': hosts},
+        }
+        with open(self.filename, 'wb') as f:
+            json.dump(config, f)
+        return sources.load_config(self.filename)
+
+    def test_host_limits(self):
+        _, hosts = self.load({'max_connections': 2, 'rate': 0.5})
+        self.assertEqual(hosts, {'www.example.com': {'max_connections': 2,
+                                                     'rate': 0.5}})
+
+    def test_invalid_host_limits(self):
+        for limits in [{'max_connection': 2}, {'max_connections': 0},
+                       {'rate': '1'}]:
+            self.assertRaises(ValueError, self.load, limits)
+
+
+if __name__ == '__main__':
+    unittest.main()